@@ -29,6 +29,9 @@ from collections import defaultdict
 import pytz
 import azure.functions as func
 
+# The function package ships its own copy of src/rate_limit.py, only this folder is deployed
+from .rate_limit import RateLimitGovernor, RateLimitPolicy
+
 # Set FORCE_COLOR to 1 to ensure color output
 os.environ["FORCE_COLOR"] = "1"
 # Check if environment variables are already set, if not, load from .env file
@@ -66,6 +69,10 @@ for var in required_env_vars:
 # Clients
 subscription_client = SubscriptionClient(credential)  # Added SubscriptionClient
 
+# Shared by every client so that throttling seen by one client slows down the others
+rate_limit_governor = RateLimitGovernor(tc)
+client_kwargs = {"per_retry_policies": [RateLimitPolicy(rate_limit_governor)]}
+
 # Define other necessary clients globally
 resource_client = None
 cost_management_client = None
@@ -150,7 +157,6 @@ def get_cost_data(scope):
     """Retrieve cost data from Azure."""
     try:
         logging.info(f"Retrieving cost data for scope: {scope}")
-        time.sleep(15)  # Delay to avoid rate limiting
         cet = pytz.timezone("CET")
         now_cet = datetime.now(cet)
         start_date = (now_cet - timedelta(days=30)).isoformat()
@@ -181,7 +187,6 @@ def get_cost_data_test(scope):
     """Retrieve cost data from Azure and export to CSV."""
     try:
         logging.info(f"Retrieving cost data for scope: {scope}")
-        time.sleep(15)  # Delay to avoid rate limiting
 
         cet = pytz.timezone("CET")
         now_cet = datetime.now(cet)
@@ -865,7 +870,7 @@ def log_empty_backend_pool(gateway, dry_run=True):
 
 def get_waste_cost_details(subscription_id, start_date, end_date):
     """Retrieve waste cost details for a subscription within a specific date range."""
-    consumption_client = ConsumptionManagementClient(credential, subscription_id)
+    consumption_client = ConsumptionManagementClient(credential, subscription_id, **client_kwargs)
     scope = f"/subscriptions/{subscription_id}"
     waste_costs = defaultdict(float)
 
@@ -1111,12 +1116,12 @@ def process_subscription(subscription, mode, summary_reports, impacted_resources
     global resource_client, cost_management_client, compute_client, storage_client, network_client, sql_client
 
     subscription_id = subscription.subscription_id
-    resource_client = ResourceManagementClient(credential, subscription_id)
-    cost_management_client = CostManagementClient(credential)
-    compute_client = ComputeManagementClient(credential, subscription_id)
-    storage_client = StorageManagementClient(credential, subscription_id)
-    network_client = NetworkManagementClient(credential, subscription_id)
-    sql_client = SqlManagementClient(credential, subscription_id)
+    resource_client = ResourceManagementClient(credential, subscription_id, **client_kwargs)
+    cost_management_client = CostManagementClient(credential, **client_kwargs)
+    compute_client = ComputeManagementClient(credential, subscription_id, **client_kwargs)
+    storage_client = StorageManagementClient(credential, subscription_id, **client_kwargs)
+    network_client = NetworkManagementClient(credential, subscription_id, **client_kwargs)
+    sql_client = SqlManagementClient(credential, subscription_id, **client_kwargs)
 
     logging.info(f'Processing subscription: {subscription_id}')
     tc.track_event("SubscriptionProcessingStarted", {"SubscriptionId": subscription_id})
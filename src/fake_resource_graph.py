@@ -0,0 +1,152 @@
+import argparse
+import base64
+import json
+import logging
+import re
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+# Local stand-in for the Azure Resource Graph query endpoint, used to test the
+# resourcegraph inventory backend of main.py offline:
+#
+#   python src/fake_resource_graph.py --fixture resources.json --port 8089
+#   RESOURCE_GRAPH_ENDPOINT=http://localhost:8089 python src/main.py --mode dry-run --inventory-backend resourcegraph
+#
+# The fixture is a JSON list of Resource Graph rows (id, name, type, subscriptionId,
+# location, sku, tags, properties, ...), or an object with such a list under "resources"
+# and resourcechanges rows (subscriptionId, properties.targetResourceId,
+# properties.targetResourceType, properties.changeType, properties.changeAttributes.timestamp)
+# under "changes". Only the KQL the optimizer sends is understood: the table name followed by
+# "type =~ '<type>'", "id in~ (...)" and "changeTime > datetime(...)" conditions.
+
+QUERY_PATH = "/providers/Microsoft.ResourceGraph/resources"
+TABLES = {
+    "resources": lambda row: not row["type"].lower().startswith("microsoft.resources/"),
+    "resourcecontainers": lambda row: row["type"].lower().startswith("microsoft.resources/"),
+}
+CHANGE_TABLES = {
+    "resourcechanges": lambda change: not change["targetResourceType"].lower().startswith("microsoft.resources/"),
+    "resourcecontainerchanges": lambda change: change["targetResourceType"].lower().startswith("microsoft.resources/"),
+}
+
+def load_fixture(fixture_file):
+    """Load the Resource Graph rows and changes served by the fake endpoint."""
+    with open(fixture_file, "r") as file:
+        fixture = json.load(file)
+    if isinstance(fixture, list):
+        fixture = {"resources": fixture}
+    fixture.setdefault("changes", [])
+    logger.info(f"Loaded {len(fixture['resources'])} rows and {len(fixture['changes'])} changes from {fixture_file}")
+    return fixture
+
+def parse_timestamp(value):
+    """Parse an ISO 8601 timestamp, accepting a trailing Z."""
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+def project_change(change):
+    """Project a resourcechanges row the way the optimizer's change query does."""
+    properties = change["properties"]
+    return {
+        "subscriptionId": change.get("subscriptionId", ""),
+        "targetResourceId": properties["targetResourceId"],
+        "targetResourceType": properties["targetResourceType"],
+        "changeType": properties["changeType"],
+        "changeTime": properties["changeAttributes"]["timestamp"],
+    }
+
+def run_query(fixture, query, subscriptions):
+    """Evaluate the subset of KQL used by the optimizer against the fixture rows."""
+    table = query.split("|")[0].strip().lower()
+    types = [value.lower() for value in re.findall(r"[tT]ype\s*=~\s*'([^']+)'", query)]
+    subscriptions = {subscription.lower() for subscription in subscriptions or []}
+    in_subscriptions = lambda row: not subscriptions or row.get("subscriptionId", "").lower() in subscriptions
+
+    if table in CHANGE_TABLES:
+        since = re.search(r"changeTime\s*>\s*datetime\(([^)]+)\)", query)
+        changes = [project_change(change) for change in fixture["changes"]]
+        return [
+            {key: change[key] for key in ("targetResourceId", "changeType", "changeTime")}
+            for change in changes
+            if CHANGE_TABLES[table](change)
+            and in_subscriptions(change)
+            and (not types or change["targetResourceType"].lower() in types)
+            and (not since or parse_timestamp(change["changeTime"]) > parse_timestamp(since.group(1)))
+        ]
+
+    if table not in TABLES:
+        raise ValueError(f"Unsupported table: {table}")
+    ids_match = re.search(r"id\s+in~\s*\(([^)]*)\)", query)
+    ids = {value.lower() for value in re.findall(r"'([^']+)'", ids_match.group(1))} if ids_match else None
+    return [
+        row for row in fixture["resources"]
+        if TABLES[table](row)
+        and in_subscriptions(row)
+        and (not types or row["type"].lower() in types)
+        and (ids is None or row["id"].lower() in ids)
+    ]
+
+def encode_skip_token(offset):
+    """Encode a row offset as an opaque skip token."""
+    return base64.urlsafe_b64encode(str(offset).encode()).decode()
+
+def decode_skip_token(skip_token):
+    """Decode a skip token produced by encode_skip_token."""
+    return int(base64.urlsafe_b64decode(skip_token.encode()).decode()) if skip_token else 0
+
+def create_handler(fixture, page_size):
+    """Create the request handler serving the fixture rows."""
+    class ResourceGraphHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if urlparse(self.path).path.lower() != QUERY_PATH.lower():
+                self.send_json(404, {"error": {"code": "NotFound", "message": f"Unknown path {self.path}"}})
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            options = body.get("options") or {}
+            try:
+                matches = run_query(fixture, body.get("query", ""), body.get("subscriptions"))
+            except ValueError as e:
+                self.send_json(400, {"error": {"code": "BadRequest", "message": str(e)}})
+                return
+            offset = decode_skip_token(options.get("$skipToken"))
+            top = min(options.get("$top") or page_size, page_size)
+            page = matches[offset:offset + top]
+            response = {
+                "totalRecords": len(matches),
+                "count": len(page),
+                "resultTruncated": "false",
+                "data": page,
+                "facets": [],
+            }
+            if offset + top < len(matches):
+                response["$skipToken"] = encode_skip_token(offset + top)
+            logger.info(f"Query {body.get('query')!r}: returning rows {offset}-{offset + len(page)} of {len(matches)}")
+            self.send_json(200, response)
+
+        def send_json(self, status, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return ResourceGraphHandler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Azure Resource Graph endpoint for offline testing")
+    parser.add_argument("--fixture", required=True, help="JSON file with the Resource Graph rows and changes to serve")
+    parser.add_argument("--port", type=int, default=8089, help="Port to listen on")
+    parser.add_argument("--page-size", type=int, default=100, help="Maximum number of rows per page, smaller pages exercise skip tokens")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("localhost", args.port), create_handler(load_fixture(args.fixture), args.page_size))
+    logger.info(f"Fake Resource Graph endpoint listening on http://localhost:{args.port}")
+    server.serve_forever()
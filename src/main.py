@@ -2,22 +2,33 @@ import argparse
 import logging
 import os
 import sys
+import asyncio
+import threading
 import time
+import contextvars
+import sqlite3
+import math
+import random
+from array import array
 from datetime import datetime, timedelta, timezone
 import json
+import hashlib
 import yaml
 import jsonschema
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from dotenv import load_dotenv
 from prettytable import PrettyTable
 from termcolor import colored
-from sklearn.ensemble import IsolationForest
 import textwrap
 from collections import defaultdict
+from itertools import zip_longest
 import pytz
 import io
-from functools import wraps
+from contextlib import closing
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, Future
 from azure.identity import DefaultAzureCredential
 from azure.mgmt.resource import ResourceManagementClient
 from azure.mgmt.costmanagement import CostManagementClient
@@ -27,10 +38,26 @@ from azure.mgmt.network import NetworkManagementClient
 from azure.mgmt.sql import SqlManagementClient
 from azure.mgmt.subscription import SubscriptionClient
 from azure.mgmt.monitor import MonitorManagementClient
+from azure.monitor.query import MetricsClient
+from azure.mgmt.resourcegraph import ResourceGraphClient
+from azure.mgmt.resourcegraph.models import QueryRequest, QueryRequestOptions, ResultFormat
+from azure.core.pipeline.policies import SansIOHTTPPolicy, RetryPolicy, AsyncRetryPolicy
+from azure.core.rest import HttpRequest
+from azure.core.exceptions import ResourceNotFoundError, ServiceRequestError, ServiceResponseError
 from azure.mgmt.sql.models import Sku, Database
+from azure.mgmt.costmanagement.models import QueryResult
 from azure.storage.filedatalake import DataLakeServiceClient
 from applicationinsights import TelemetryClient
-from azure.mgmt.compute.models import StorageAccountTypes
+from azure.mgmt.compute.models import StorageAccountTypes, DiskUpdate, DiskSku
+import aiohttp
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+from azure.mgmt.resource.resources.aio import ResourceManagementClient as AsyncResourceManagementClient
+from azure.mgmt.compute.aio import ComputeManagementClient as AsyncComputeManagementClient
+from azure.mgmt.storage.aio import StorageManagementClient as AsyncStorageManagementClient
+from azure.mgmt.network.aio import NetworkManagementClient as AsyncNetworkManagementClient
+from azure.mgmt.sql.aio import SqlManagementClient as AsyncSqlManagementClient
+from rate_limit import RateLimitGovernor, RateLimitPolicy, AsyncRateLimitPolicy, get_retry_after
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -92,24 +119,593 @@ service_client = DataLakeServiceClient(
     credential=credential
 )
 
-def retry(max_retries=3, delay=5, backoff=2, exceptions=(Exception,)):
-    """Retry decorator with exponential backoff and jitter for resilience in case of transient errors."""
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            retries = 0
-            current_delay = delay
-            while retries < max_retries:
-                try:
-                    return func(*args, **kwargs)
-                except exceptions as e:
-                    logger.warning(f"Exception occurred: {e}. Retrying in {current_delay} seconds...")
-                    time.sleep(current_delay)
-                    current_delay *= backoff
-                    retries += 1
-            return func(*args, **kwargs)
-        return wrapper
-    return decorator
+# Resource Graph tables and types backing the policy resource types. Types that are not
+# listed here are always listed through their management client.
+RESOURCE_GRAPH_TYPES = {
+    "azure.vm": ("Resources", "microsoft.compute/virtualmachines"),
+    "azure.disk": ("Resources", "microsoft.compute/disks"),
+    "azure.resourcegroup": ("ResourceContainers", "microsoft.resources/subscriptions/resourcegroups"),
+    "azure.storage": ("Resources", "microsoft.storage/storageaccounts"),
+    "azure.publicip": ("Resources", "microsoft.network/publicipaddresses"),
+    "azure.sql": ("Resources", "microsoft.sql/servers/databases"),
+    "azure.applicationgateway": ("Resources", "microsoft.network/applicationgateways"),
+    "azure.nic": ("Resources", "microsoft.network/networkinterfaces"),
+    "azure.loadbalancer": ("Resources", "microsoft.network/loadbalancers"),
+    "azure.natgateway": ("Resources", "microsoft.network/natgateways"),
+}
+# Resource types whose references to each other make up the subscription reference graph
+REFERENCE_GRAPH_TYPES = ["azure.publicip", "azure.nic", "azure.loadbalancer", "azure.natgateway", "azure.applicationgateway", "azure.disk"]
+# Days of daily cost analyzed per scope
+COST_HISTORY_DAYS = 30
+# Listings of the subscriptions under a --cost-scope, per scope type: (relative path, API version)
+COST_SCOPE_SUBSCRIPTION_LISTS = {
+    "microsoft.management/managementgroups": ("descendants", "2020-05-01"),
+    "microsoft.billing/billingaccounts": ("billingSubscriptions", "2024-04-01"),
+}
+# Dimensions of the cost cube. Its rows are queried per resource id and meter category,
+# the subscription and resource group are derived from the resource id.
+COST_CUBE_DIMENSIONS = ["subscription", "resource_group", "resource_id", "meter_category"]
+# Modified z-score (distance from the median in scaled median absolute deviations) above which
+# the cost of a day is an anomaly of its series, and the fewest days a series needs to be scored
+ANOMALY_SCORE_THRESHOLD = 3.5
+ANOMALY_MIN_DAYS = 7
+# Resource types captured in simulation snapshots, including the ones only needed for the reference graph
+SNAPSHOT_RESOURCE_TYPES = ["azure.vm", "azure.disk", "azure.resourcegroup", "azure.storage", "azure.publicip", "azure.sql", "azure.applicationgateway", "azure.nic", "azure.loadbalancer", "azure.natgateway"]
+# Minimum number of days of hourly CPU usage captured per VM, so policies can be simulated with other last_used windows
+SNAPSHOT_METRICS_DAYS = 30
+# The batch metrics endpoint is regional and accepts up to 50 resources of one subscription per call
+METRICS_ENDPOINT = "https://{region}.metrics.monitor.azure.com"
+METRICS_BATCH_SIZE = 50
+# Hours re-fetched before the end of a cached CPU series, the latest hours may still be ingested
+CPU_SERIES_OVERLAP_HOURS = 2
+# HTTP status codes worth retrying; any other HTTP error is permanent.
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# Consecutive transient failures that open an endpoint's circuit breaker, and how long it stays open.
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_COOLDOWN = 60
+# Pending operations still unresolved after this long are reported as failed
+OPERATION_TIMEOUT = timedelta(hours=24)
+# Fields of an ETag-less resource its desired-state fingerprint covers: what the sku, tag and unattached filters read
+FINGERPRINT_FIELDS = ["id", "sku", "tags", "managed_by"]
+# Resource Graph accepts at most 1000 subscriptions per query and returns at most 1000 rows per page
+RESOURCE_GRAPH_MAX_SUBSCRIPTIONS = 1000
+RESOURCE_GRAPH_PAGE_SIZE = 1000
+# Change tables used to refresh the inventory cache incrementally. Resource Graph keeps
+# 14 days of changes, older snapshots are refreshed in full.
+RESOURCE_GRAPH_CHANGE_TABLES = {
+    "Resources": "resourcechanges",
+    "ResourceContainers": "resourcecontainerchanges",
+}
+RESOURCE_GRAPH_CHANGE_RETENTION = timedelta(days=14)
+# Changes can show up in Resource Graph a few minutes after they happen
+RESOURCE_GRAPH_CHANGE_OVERLAP = timedelta(minutes=30)
+RESOURCE_GRAPH_ID_BATCH_SIZE = 200
+
+class OfflinePolicy(SansIOHTTPPolicy):
+    """Pipeline policy failing every request of a simulation before it is authenticated or sent."""
+
+    def on_request(self, request):
+        raise ServiceRequestError(f"Simulation makes no network calls: {request.http_request.method} {request.http_request.url.split('?')[0]}")
+
+def create_run_context(inventory_backend="arm", subscription_ids=(), inventory_cache=None, full_refresh=False, max_parallel_metric_queries=8, metrics_cache=None, metrics_retention_days=0, max_parallel_actions=1, max_parallel_actions_per_type=None, record_plan=False, operations_store=None, max_parallel_sql_scales=1, max_parallel_sql_scales_per_server=None, state_store=None, offline=False, cost_store=None, cost_restatement_days=3, reference_time=None):
+    """Create the settings and state shared by every subscription of a run."""
+    resource_graph = None
+    if inventory_backend == "resourcegraph":
+        resource_graph = SimpleNamespace(
+            client=create_resource_graph_client(),
+            subscription_ids=list(subscription_ids),
+            cache_file=inventory_cache,
+            full_refresh=full_refresh,
+            rows={},
+            lock=threading.Lock(),
+            type_locks={},
+        )
+    cpu_series_cache = None
+    if metrics_cache:
+        cpu_series_cache = SimpleNamespace(cache_file=metrics_cache, retention_days=metrics_retention_days)
+    return SimpleNamespace(
+        inventory_backend=inventory_backend,
+        resource_graph=resource_graph,
+        max_parallel_metric_queries=max_parallel_metric_queries,
+        metrics_cache=cpu_series_cache,
+        max_parallel_actions=max_parallel_actions,
+        max_parallel_actions_per_type=max_parallel_actions_per_type or max_parallel_actions,
+        plan=SimpleNamespace(entries=[], lock=threading.Lock()) if record_plan else None,
+        operations_store=operations_store,
+        state_store=state_store,
+        offline=offline,
+        # The time filters and cost reports are evaluated at, the capture time of a simulated snapshot or None for now
+        reference_time=reference_time,
+        cost_store=SimpleNamespace(store_file=cost_store, restatement_days=cost_restatement_days) if cost_store else None,
+        # Cost data per lower-cased subscription scope, filled by query_grouped_cost_data when a cost scope is set
+        grouped_cost_data={},
+        rate_limit_governor=RateLimitGovernor(tc),
+        circuit_breakers={},
+        circuit_breakers_lock=threading.Lock(),
+        max_parallel_sql_scales=max_parallel_sql_scales,
+        max_parallel_sql_scales_per_server=max_parallel_sql_scales_per_server or max_parallel_sql_scales,
+        # Start and end of the SQL rescales of the whole run, for its time-to-converge
+        sql_fleet=SimpleNamespace(started=None, converged=None, databases=0, lock=threading.Lock()),
+    )
+
+def get_reference_time(tz=timezone.utc):
+    """Return the time the run is evaluated at in the given timezone: the capture time of a simulated snapshot, otherwise now."""
+    reference_time = get_run_context().reference_time
+    return reference_time.astimezone(tz) if reference_time else datetime.now(tz)
+
+def create_resource_graph_client():
+    """Create the Resource Graph client, pointing it at RESOURCE_GRAPH_ENDPOINT when set (e.g. a local fake endpoint)."""
+    endpoint = os.getenv("RESOURCE_GRAPH_ENDPOINT")
+    if endpoint:
+        logger.info(f"Using Resource Graph endpoint: {endpoint}")
+        # The local fake endpoint does not require a bearer token
+        return ResourceGraphClient(credential, base_url=endpoint, authentication_policy=SansIOHTTPPolicy(), retry_policy=TransientRetryPolicy())
+    return ResourceGraphClient(credential, retry_policy=TransientRetryPolicy())
+
+# Run-wide settings and state. Worker threads and tasks inherit it from the context of main().
+run_context = contextvars.ContextVar("run_context", default=create_run_context())
+
+def get_run_context():
+    """Return the settings and state shared by every subscription of the current run."""
+    return run_context.get()
+
+# ARM clients of the subscription being processed. Every subscription worker
+# runs in its own context, so parallel workers never share clients.
+client_context = contextvars.ContextVar("client_context")
+# pyplot keeps global figure state, so cost trend plots are rendered one at a time.
+plot_lock = threading.Lock()
+
+def get_client_kwargs():
+    """Return the pipeline policies shared by the synchronous clients of the run."""
+    # Every client paces its requests through the rate limit governor of the run instead of fixed sleeps
+    # Transient errors are retried by TransientRetryPolicy in place of the azure-core retry policy
+    client_kwargs = {"retry_policy": TransientRetryPolicy(), "per_retry_policies": [RateLimitPolicy(get_run_context().rate_limit_governor)]}
+    if get_run_context().offline:
+        client_kwargs["per_call_policies"] = [OfflinePolicy()]
+    return client_kwargs
+
+def create_subscription_clients(subscription_id):
+    """Create the ARM clients used to process a single subscription."""
+    client_kwargs = get_client_kwargs()
+    return SimpleNamespace(
+        subscription_id=subscription_id,
+        resource_client=ResourceManagementClient(credential, subscription_id, **client_kwargs),
+        cost_management_client=CostManagementClient(credential, **client_kwargs),
+        compute_client=ComputeManagementClient(credential, subscription_id, **client_kwargs),
+        storage_client=StorageManagementClient(credential, subscription_id, **client_kwargs),
+        network_client=NetworkManagementClient(credential, subscription_id, **client_kwargs),
+        sql_client=SqlManagementClient(credential, subscription_id, **client_kwargs),
+        inventory={},
+        inventory_lock=threading.Lock(),
+        inventory_type_locks={},
+        power_states=None,
+        reference_graph=None,
+        disk_index=None,
+        desired_state=None,
+        metrics_clients={},
+        cpu_usage={},
+        cpu_usage_lock=threading.Lock(),
+        action_slots=threading.BoundedSemaphore(get_run_context().max_parallel_actions),
+        action_executors={},
+    )
+
+def get_clients():
+    """Return the ARM clients of the subscription processed in the current context."""
+    return client_context.get()
+
+def list_resources(resource_type):
+    """Return the resources of a type for the current subscription, listing them once per run on first use."""
+    clients = get_clients()
+    with clients.inventory_lock:
+        type_lock = clients.inventory_type_locks.setdefault(resource_type, threading.Lock())
+    # Policies evaluated concurrently wait for the same listing instead of starting their own
+    with type_lock:
+        if resource_type not in clients.inventory:
+            listing_start = time.perf_counter()
+            if get_run_context().resource_graph and resource_type in RESOURCE_GRAPH_TYPES:
+                clients.inventory[resource_type] = list_resources_from_resource_graph(resource_type)
+            else:
+                clients.inventory[resource_type] = list_resources_from_arm(resource_type)
+            logger.info(f"Listed {len(clients.inventory[resource_type])} {resource_type} resources for subscription {clients.subscription_id} in {time.perf_counter() - listing_start:.2f} seconds")
+        return clients.inventory[resource_type]
+
+def get_power_state_code(statuses):
+    """Return the PowerState/* code of a VM instance view, or None when it is not reported."""
+    return next((status.code for status in statuses or [] if status.code and status.code.startswith("PowerState/")), None)
+
+def get_power_states():
+    """Return the power state of every VM in the current subscription, indexed by lower-cased VM id."""
+    clients = get_clients()
+    with clients.inventory_lock:
+        type_lock = clients.inventory_type_locks.setdefault("power_states", threading.Lock())
+    with type_lock:
+        if clients.power_states is None:
+            listing_start = time.perf_counter()
+            # One paginated status-only listing replaces an instance_view call per VM
+            clients.power_states = {
+                vm.id.lower(): get_power_state_code(vm.instance_view.statuses if vm.instance_view else None)
+                for vm in clients.compute_client.virtual_machines.list_all(status_only="true")
+            }
+            logger.info(f"Listed power states of {len(clients.power_states)} VMs for subscription {clients.subscription_id} in {time.perf_counter() - listing_start:.2f} seconds")
+        return clients.power_states
+
+def get_power_state(vm):
+    """Return the power state code of a VM from the subscription power-state index."""
+    power_states = get_power_states()
+    vm_id = vm.id.lower()
+    if vm_id not in power_states:
+        # VMs created after the index was built fall back to their own instance view
+        resource_group_name = vm.id.split("/")[4]
+        instance_view = get_clients().compute_client.virtual_machines.instance_view(resource_group_name, vm.name)
+        power_states[vm_id] = get_power_state_code(instance_view.statuses)
+    return power_states[vm_id]
+
+def query_resource_graph(query, subscription_ids):
+    """Run a Resource Graph query across subscriptions, following skip tokens, and return all rows."""
+    resource_graph_client = get_run_context().resource_graph.client
+    rows = []
+    for offset in range(0, len(subscription_ids), RESOURCE_GRAPH_MAX_SUBSCRIPTIONS):
+        subscriptions = subscription_ids[offset:offset + RESOURCE_GRAPH_MAX_SUBSCRIPTIONS]
+        skip_token = None
+        while True:
+            response = resource_graph_client.resources(
+                QueryRequest(
+                    subscriptions=subscriptions,
+                    query=query,
+                    options=QueryRequestOptions(
+                        skip_token=skip_token,
+                        top=RESOURCE_GRAPH_PAGE_SIZE,
+                        result_format=ResultFormat.OBJECT_ARRAY,
+                    ),
+                )
+            )
+            rows.extend(response.data)
+            skip_token = response.skip_token
+            if not skip_token:
+                break
+    return rows
+
+def get_resource_graph_rows(resource_type):
+    """Return the Resource Graph rows of a resource type for all subscriptions of the run, grouped by subscription."""
+    resource_graph = get_run_context().resource_graph
+    with resource_graph.lock:
+        type_lock = resource_graph.type_locks.setdefault(resource_type, threading.Lock())
+    # One query per resource type for the whole tenant, shared by every subscription worker
+    with type_lock:
+        if resource_type not in resource_graph.rows:
+            query_start = time.perf_counter()
+            if resource_graph.cache_file:
+                rows = load_cached_resource_graph_rows(resource_type, resource_graph.subscription_ids)
+            else:
+                table, type_name = RESOURCE_GRAPH_TYPES[resource_type]
+                rows = query_resource_graph(f"{table} | where type =~ '{type_name}'", resource_graph.subscription_ids)
+            rows_by_subscription = defaultdict(list)
+            for row in rows:
+                rows_by_subscription[row["subscriptionId"].lower()].append(row)
+            resource_graph.rows[resource_type] = rows_by_subscription
+            logger.info(f"Loaded {len(rows)} {resource_type} resources from Resource Graph across {len(resource_graph.subscription_ids)} subscription(s) in {time.perf_counter() - query_start:.2f} seconds")
+        return resource_graph.rows[resource_type]
+
+def open_inventory_cache(cache_file):
+    """Open the on-disk inventory cache, creating its tables on first use."""
+    os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+    connection = sqlite3.connect(cache_file, timeout=30)
+    connection.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS resources (
+            resource_id TEXT PRIMARY KEY,
+            resource_type TEXT NOT NULL,
+            subscription_id TEXT NOT NULL,
+            etag TEXT,
+            changed_time TEXT NOT NULL,
+            payload TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS resources_by_type ON resources (resource_type, subscription_id);
+        CREATE TABLE IF NOT EXISTS snapshots (
+            resource_type TEXT NOT NULL,
+            subscription_id TEXT NOT NULL,
+            refreshed_at TEXT NOT NULL,
+            PRIMARY KEY (resource_type, subscription_id)
+        );
+        """
+    )
+    return connection
+
+def store_resource_graph_rows(connection, resource_type, rows, changed_time):
+    """Insert or replace Resource Graph rows in the inventory cache."""
+    connection.executemany(
+        "INSERT OR REPLACE INTO resources (resource_id, resource_type, subscription_id, etag, changed_time, payload) VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (row["id"].lower(), resource_type, row["subscriptionId"].lower(), row.get("etag"), changed_time, json.dumps(row))
+            for row in rows
+        ],
+    )
+
+def query_resource_graph_changes(resource_type, subscription_ids, since):
+    """Return the latest change type and time of every resource of a type changed since a point in time."""
+    table, type_name = RESOURCE_GRAPH_TYPES[resource_type]
+    query = (
+        f"{RESOURCE_GRAPH_CHANGE_TABLES[table]}"
+        " | extend changeTime = todatetime(properties.changeAttributes.timestamp),"
+        " targetResourceId = tostring(properties.targetResourceId),"
+        " targetResourceType = tostring(properties.targetResourceType),"
+        " changeType = tostring(properties.changeType)"
+        f" | where changeTime > datetime({since.isoformat()}) and targetResourceType =~ '{type_name}'"
+        " | project targetResourceId, changeType, changeTime"
+    )
+    changes = {}
+    for change in sorted(query_resource_graph(query, subscription_ids), key=lambda change: change["changeTime"]):
+        changes[change["targetResourceId"].lower()] = (change["changeType"], change["changeTime"])
+    return changes
+
+def query_resource_graph_by_ids(resource_type, resource_ids, subscription_ids):
+    """Return the current Resource Graph rows of specific resources."""
+    table, type_name = RESOURCE_GRAPH_TYPES[resource_type]
+    rows = []
+    for offset in range(0, len(resource_ids), RESOURCE_GRAPH_ID_BATCH_SIZE):
+        ids = ", ".join(f"'{resource_id}'" for resource_id in resource_ids[offset:offset + RESOURCE_GRAPH_ID_BATCH_SIZE])
+        rows.extend(query_resource_graph(f"{table} | where type =~ '{type_name}' | where id in~ ({ids})", subscription_ids))
+    return rows
+
+def load_cached_resource_graph_rows(resource_type, subscription_ids):
+    """Return the Resource Graph rows of a resource type from the inventory cache, refreshing only what changed since the last snapshot."""
+    resource_graph = get_run_context().resource_graph
+    table, type_name = RESOURCE_GRAPH_TYPES[resource_type]
+    refresh_time = datetime.now(timezone.utc)
+    subscription_ids = [subscription_id.lower() for subscription_id in subscription_ids]
+
+    with closing(open_inventory_cache(resource_graph.cache_file)) as connection, connection:
+        snapshots = {
+            subscription_id: datetime.fromisoformat(refreshed_at)
+            for subscription_id, refreshed_at in connection.execute(
+                "SELECT subscription_id, refreshed_at FROM snapshots WHERE resource_type = ?", (resource_type,)
+            )
+        }
+        full_refresh_ids = [
+            subscription_id for subscription_id in subscription_ids
+            if resource_graph.full_refresh
+            or subscription_id not in snapshots
+            or refresh_time - snapshots[subscription_id] > RESOURCE_GRAPH_CHANGE_RETENTION
+        ]
+        incremental_ids = [subscription_id for subscription_id in subscription_ids if subscription_id not in full_refresh_ids]
+
+        if full_refresh_ids:
+            rows = query_resource_graph(f"{table} | where type =~ '{type_name}'", full_refresh_ids)
+            connection.executemany(
+                "DELETE FROM resources WHERE resource_type = ? AND subscription_id = ?",
+                [(resource_type, subscription_id) for subscription_id in full_refresh_ids],
+            )
+            store_resource_graph_rows(connection, resource_type, rows, refresh_time.isoformat())
+            logger.info(f"Full inventory refresh of {resource_type}: {len(rows)} resources in {len(full_refresh_ids)} subscription(s)")
+
+        if incremental_ids:
+            since = min(snapshots[subscription_id] for subscription_id in incremental_ids) - RESOURCE_GRAPH_CHANGE_OVERLAP
+            changes = query_resource_graph_changes(resource_type, incremental_ids, since)
+            changed_ids = [resource_id for resource_id, (change_type, _) in changes.items() if change_type != "Delete"]
+            rows = query_resource_graph_by_ids(resource_type, changed_ids, incremental_ids) if changed_ids else []
+            for row in rows:
+                store_resource_graph_rows(connection, resource_type, [row], changes[row["id"].lower()][1])
+            # Resources that were deleted, or changed and then deleted, no longer exist
+            found_ids = {row["id"].lower() for row in rows}
+            deleted_ids = [resource_id for resource_id in changes if resource_id not in found_ids]
+            connection.executemany("DELETE FROM resources WHERE resource_id = ?", [(resource_id,) for resource_id in deleted_ids])
+            logger.info(f"Incremental inventory refresh of {resource_type} since {since.isoformat()}: {len(rows)} changed, {len(deleted_ids)} deleted")
+
+        connection.executemany(
+            "INSERT OR REPLACE INTO snapshots (resource_type, subscription_id, refreshed_at) VALUES (?, ?, ?)",
+            [(resource_type, subscription_id, refresh_time.isoformat()) for subscription_id in subscription_ids],
+        )
+        requested = set(subscription_ids)
+        return [
+            json.loads(payload)
+            for subscription_id, payload in connection.execute(
+                "SELECT subscription_id, payload FROM resources WHERE resource_type = ?", (resource_type,)
+            )
+            if subscription_id in requested
+        ]
+
+def get_resource_model(resource_type):
+    """Return the SDK model class the management clients use for a policy resource type."""
+    clients = get_clients()
+    return {
+        "azure.vm": clients.compute_client.virtual_machines.models.VirtualMachine,
+        "azure.disk": clients.compute_client.disks.models.Disk,
+        "azure.resourcegroup": clients.resource_client.resource_groups.models.ResourceGroup,
+        "azure.storage": clients.storage_client.storage_accounts.models.StorageAccount,
+        "azure.publicip": clients.network_client.public_ip_addresses.models.PublicIPAddress,
+        "azure.sql": clients.sql_client.databases.models.Database,
+        "azure.applicationgateway": clients.network_client.application_gateways.models.ApplicationGateway,
+        "azure.nic": clients.network_client.network_interfaces.models.NetworkInterface,
+        "azure.loadbalancer": clients.network_client.load_balancers.models.LoadBalancer,
+        "azure.natgateway": clients.network_client.nat_gateways.models.NatGateway,
+    }[resource_type]
+
+def list_resources_from_resource_graph(resource_type):
+    """List the resources of a policy resource type for the current subscription from the tenant-wide Resource Graph snapshot."""
+    rows = get_resource_graph_rows(resource_type).get(get_clients().subscription_id.lower(), [])
+    # Resource Graph rows have the ARM resource shape, so they deserialize into the same
+    # models the management clients return and the existing filters keep working
+    model = get_resource_model(resource_type)
+    return [model.deserialize(row) for row in rows]
+
+def list_resources_from_arm(resource_type):
+    """List all resources of a policy resource type through the ARM clients."""
+    clients = get_clients()
+    if resource_type == "azure.vm":
+        return list(clients.compute_client.virtual_machines.list_all())
+    elif resource_type == "azure.disk":
+        return list(clients.compute_client.disks.list())
+    elif resource_type == "azure.resourcegroup":
+        return list(clients.resource_client.resource_groups.list())
+    elif resource_type == "azure.storage":
+        return list(clients.storage_client.storage_accounts.list())
+    elif resource_type == "azure.publicip":
+        return list(clients.network_client.public_ip_addresses.list_all())
+    elif resource_type == "azure.sql":
+        databases = []
+        for server in clients.sql_client.servers.list():
+            resource_group_name = server.id.split("/")[4]
+            databases.extend(clients.sql_client.databases.list_by_server(resource_group_name, server.name))
+        return databases
+    elif resource_type == "azure.applicationgateway":
+        return list(clients.network_client.application_gateways.list_all())
+    elif resource_type == "azure.nic":
+        return list(clients.network_client.network_interfaces.list_all())
+    elif resource_type == "azure.loadbalancer":
+        return list(clients.network_client.load_balancers.list_all())
+    elif resource_type == "azure.natgateway":
+        return list(clients.network_client.nat_gateways.list_all())
+    raise ValueError(f"Unsupported resource type: {resource_type}")
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint whose circuit breaker is open."""
+
+class CircuitBreaker:
+    """Fails calls to an endpoint fast for a cooldown after repeated transient failures."""
+
+    def __init__(self, endpoint, threshold=CIRCUIT_BREAKER_THRESHOLD, cooldown=CIRCUIT_BREAKER_COOLDOWN):
+        self.endpoint = endpoint
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_until = 0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError while the breaker is open; once the cooldown passes a single trial call goes through."""
+        with self.lock:
+            remaining = self.opened_until - time.monotonic()
+            if remaining <= 0 and self.failures >= self.threshold:
+                # Half-open: the other calls fail fast until the trial call has succeeded or reopened the breaker
+                if self.probing:
+                    raise CircuitOpenError(f"Circuit breaker for {self.endpoint} is half-open and waiting for its trial call")
+                self.probing = True
+        if remaining > 0:
+            raise CircuitOpenError(f"Circuit breaker for {self.endpoint} is open for another {remaining:.0f} seconds")
+
+    def record_success(self):
+        """Close the breaker."""
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        """Count a transient failure and return True when it (re)opens the breaker."""
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.failures < self.threshold:
+                return False
+            self.opened_until = time.monotonic() + self.cooldown
+            return True
+
+def get_circuit_breaker(endpoint):
+    """Return the run-wide circuit breaker of an endpoint."""
+    context = get_run_context()
+    with context.circuit_breakers_lock:
+        if endpoint not in context.circuit_breakers:
+            context.circuit_breakers[endpoint] = CircuitBreaker(endpoint)
+        return context.circuit_breakers[endpoint]
+
+def get_request_endpoint(request):
+    """Return the endpoint a request is counted under by the circuit breakers: its host, subscription and innermost provider."""
+    url = request.url.split("?")[0].lower()
+    host = url.split("/")[2] if "//" in url else url
+    # One subscription failing must not open the breaker of the others
+    subscription = url.split("/subscriptions/")[1].split("/")[0] if "/subscriptions/" in url else None
+    providers = url.split("/providers/")
+    endpoint = f"{host}/subscriptions/{subscription}" if subscription else host
+    return f"{endpoint}/{providers[-1].split('/')[0]}" if len(providers) > 1 else endpoint
+
+class TransientRetryPolicy(RetryPolicy):
+    """Retry policy for transient errors with decorrelated jitter, Retry-After support and a per-endpoint circuit breaker.
+
+    It replaces the azure-core RetryPolicy of the clients, so every attempt is counted and paced here and retries do not nest.
+    """
+
+    def __init__(self, max_retries=3, delay=1, max_delay=60):
+        super().__init__(retry_total=max_retries)
+        self.max_retries = max_retries
+        self.delay = delay
+        self.max_delay = max_delay
+
+    def get_retry_delay(self, request, circuit_breaker, attempt, sleep, error, retry_after, throttled=False):
+        """Count a transient failure and return the decorrelated jitter sleep and the wait before the next attempt, or None to give up."""
+        endpoint = circuit_breaker.endpoint
+        if throttled:
+            # Throttling shows the endpoint is up, the Retry-After pacing handles it and it does not count towards the breaker
+            circuit_breaker.record_success()
+            opened = False
+        else:
+            opened = circuit_breaker.record_failure()
+        if opened:
+            logger.error(f"Circuit breaker for {endpoint} opened for {circuit_breaker.cooldown} seconds after {circuit_breaker.failures} consecutive failures")
+            tc.track_event("CircuitBreakerOpened", {"Endpoint": endpoint})
+        if opened or attempt == self.max_retries:
+            tc.track_metric("RetriesExhausted", 1, properties={"Endpoint": endpoint, "Error": error})
+            return None
+        # Decorrelated jitter: the next sleep is drawn between the base delay and three times the previous one
+        sleep = min(self.max_delay, random.uniform(self.delay, sleep * 3))
+        wait = max(sleep, retry_after)
+        logger.warning(f"Transient error on {request.method} {request.url.split('?')[0]} (attempt {attempt + 1}/{self.max_retries + 1}): {error}. Retrying in {wait:.1f} seconds...")
+        tc.track_metric("Retries", 1, properties={"Endpoint": endpoint, "Error": error})
+        return sleep, wait
+
+    def send(self, request):
+        circuit_breaker = get_circuit_breaker(get_request_endpoint(request.http_request))
+        sleep = self.delay
+        for attempt in range(self.max_retries + 1):
+            circuit_breaker.before_call()
+            try:
+                response = self.next.send(request)
+            except (ServiceRequestError, ServiceResponseError) as e:
+                retry = self.get_retry_delay(request.http_request, circuit_breaker, attempt, sleep, type(e).__name__, 0)
+                if retry is None:
+                    raise
+            else:
+                status_code = response.http_response.status_code
+                # Any other status, including 401 and 404, is permanent and shows the endpoint is up
+                if status_code not in TRANSIENT_STATUS_CODES:
+                    circuit_breaker.record_success()
+                    return response
+                retry_after = get_retry_after(response.http_response.headers)
+                retry = self.get_retry_delay(request.http_request, circuit_breaker, attempt, sleep, f"HTTP {status_code}", retry_after, status_code == 429 or retry_after > 0)
+                if retry is None:
+                    # The client raises the HttpResponseError of the last response
+                    return response
+            sleep, wait = retry
+            time.sleep(wait)
+
+class AsyncTransientRetryPolicy(AsyncRetryPolicy):
+    """Async counterpart of TransientRetryPolicy for the aio clients, sharing its circuit breakers."""
+
+    def __init__(self, max_retries=3, delay=1, max_delay=60):
+        super().__init__(retry_total=max_retries)
+        self.retry_policy = TransientRetryPolicy(max_retries, delay, max_delay)
+
+    async def send(self, request):
+        circuit_breaker = get_circuit_breaker(get_request_endpoint(request.http_request))
+        sleep = self.retry_policy.delay
+        for attempt in range(self.retry_policy.max_retries + 1):
+            circuit_breaker.before_call()
+            try:
+                response = await self.next.send(request)
+            except (ServiceRequestError, ServiceResponseError) as e:
+                retry = self.retry_policy.get_retry_delay(request.http_request, circuit_breaker, attempt, sleep, type(e).__name__, 0)
+                if retry is None:
+                    raise
+            else:
+                status_code = response.http_response.status_code
+                if status_code not in TRANSIENT_STATUS_CODES:
+                    circuit_breaker.record_success()
+                    return response
+                retry_after = get_retry_after(response.http_response.headers)
+                retry = self.retry_policy.get_retry_delay(request.http_request, circuit_breaker, attempt, sleep, f"HTTP {status_code}", retry_after, status_code == 429 or retry_after > 0)
+                if retry is None:
+                    return response
+            sleep, wait = retry
+            await asyncio.sleep(wait)
 
 def list_files_in_directory(directory_path):
     """Function to list files in a directory."""
@@ -179,117 +775,407 @@ def load_policies(policy_file, schema_file):
     jsonschema.validate(instance=policies, schema=schema)
     return policies["policies"]
 
-@retry(max_retries=5, delay=10, backoff=2, exceptions=(Exception,))
-def get_cost_data(scope):
-    """Retrieve cost data from Azure."""
-    try:
-        logger.info(f"Retrieving cost data for scope: {scope}")
+def query_cost_page(cost_management_client, scope, parameters, next_link=None):
+    """Query one page of a Cost Management query, raising once the retry policy of the client gives up."""
+    if next_link is None:
+        return cost_management_client.query.usage(scope, parameters)
+    # Continuation pages are requested by posting the same query to the next link
+    response = cost_management_client._send_request(HttpRequest("POST", next_link, json=parameters))
+    response.raise_for_status()
+    return QueryResult.deserialize(json.loads(response.text()))
 
-        cet = pytz.timezone("CET")
-        now_cet = datetime.now(cet)
+def query_cost_data(scope, start_date=None, end_date=None, group_by=None, cost_management_client=None):
+    """Query the daily cost of a scope (by default the last 30 days) with all of its pages."""
+    logger.info(f"Retrieving cost data for scope: {scope}")
 
-        start_date = (now_cet - timedelta(days=30)).isoformat()
-        end_date = now_cet.isoformat()
+    cet = pytz.timezone("CET")
+    now_cet = get_reference_time(cet)
 
-        cost_data = cost_management_client.query.usage(
-            scope,
-            {
-                "type": "Usage",
-                "timeframe": "Custom",
-                "timePeriod": {"from": start_date, "to": end_date},
-                "dataset": {
-                    "granularity": "Daily",
-                    "aggregation": {
-                        "totalCost": {"name": "PreTaxCost", "function": "Sum"}
-                    },
-                },
-            },
-        )
+    start_date = start_date or (now_cet - timedelta(days=COST_HISTORY_DAYS)).isoformat()
+    end_date = end_date or now_cet.isoformat()
+
+    dataset = {
+        "granularity": "Daily",
+        "aggregation": {
+            "totalCost": {"name": "PreTaxCost", "function": "Sum"}
+        },
+    }
+    if group_by:
+        dataset["grouping"] = [{"type": "Dimension", "name": name} for name in group_by]
+    parameters = {
+        "type": "Usage",
+        "timeframe": "Custom",
+        "timePeriod": {"from": start_date, "to": end_date},
+        "dataset": dataset,
+    }
+    cost_management_client = cost_management_client or get_clients().cost_management_client
+    cost_data = query_cost_page(cost_management_client, scope, parameters)
+    rows, page = list(cost_data.rows or []), cost_data
+    while page.next_link:
+        page = query_cost_page(cost_management_client, scope, parameters, page.next_link)
+        rows.extend(page.rows or [])
+    cost_data.rows, cost_data.next_link = rows, None
+    return cost_data
 
-        return cost_data
+def get_cost_data(scope):
+    """Retrieve cost data from Azure, returning None once retries are exhausted or on a permanent error."""
+    try:
+        grouped_cost_data = get_run_context().grouped_cost_data
+        if scope.lower() in grouped_cost_data:
+            # Already split from the query at the billing account or management group scope
+            return grouped_cost_data[scope.lower()]
+        if get_run_context().cost_store:
+            return get_stored_cost_data(scope)
+        return query_cost_data(scope)
     except Exception as e:
         logger.error(f"Failed to retrieve cost data for scope {scope}: {e}")
         return None
 
-def analyze_cost_data(cost_data, subscription_id, summary_reports):
-    """Analyze cost data until yesterday, detect trends, anomalies, and generate reports."""
-    data = []
+def open_cost_store(store_file):
+    """Open the daily cost store, creating its table on first use."""
+    os.makedirs(os.path.dirname(store_file) or ".", exist_ok=True)
+    connection = sqlite3.connect(store_file, timeout=30)
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS daily_cost (
+            scope TEXT NOT NULL,
+            usage_date INTEGER NOT NULL,
+            cost REAL,
+            currency TEXT,
+            fetched_at TEXT NOT NULL,
+            PRIMARY KEY (scope, usage_date)
+        )
+        """
+    )
+    return connection
+
+def get_usage_date(day):
+    """Return the YYYYMMDD integer Cost Management uses for a day."""
+    return int(day.strftime("%Y%m%d"))
+
+def get_cost_query_start(stored_dates, first_day, last_day, restatement_days):
+    """Return the first day to query: the first missing day, or the first day of the restatement window."""
+    restatement_start = last_day - timedelta(days=restatement_days - 1)
+    day = first_day
+    while day < restatement_start and get_usage_date(day) in stored_dates:
+        day += timedelta(days=1)
+    return day
+
+def get_cost_history_days():
+    """Return the first and last day of the analyzed cost history."""
+    last_day = datetime.now(pytz.timezone("CET")).date()
+    return last_day - timedelta(days=COST_HISTORY_DAYS), last_day
+
+def get_stored_cost_query_start(scope, first_day, last_day):
+    """Return the first day of a scope that has to be queried to complete the cost store."""
+    cost_store = get_run_context().cost_store
+    with closing(open_cost_store(cost_store.store_file)) as connection:
+        stored_dates = {
+            usage_date
+            for usage_date, in connection.execute(
+                "SELECT usage_date FROM daily_cost WHERE scope = ? AND usage_date >= ?", (scope, get_usage_date(first_day))
+            )
+        }
+    return get_cost_query_start(stored_dates, first_day, last_day, cost_store.restatement_days)
+
+def store_cost_rows(scope, rows, query_start, first_day, last_day):
+    """Store the queried (cost, usage date, currency) rows of a scope and return all of its stored rows."""
+    fetched_at = datetime.now(timezone.utc).isoformat()
+    # Cost Management returns no row for days without usage. Those days are stored without a cost, so they
+    # count as fetched but are left out of the analysis like before, instead of reading as zero cost
+    days = {get_usage_date(query_start + timedelta(days=offset)): (None, None) for offset in range((last_day - query_start).days + 1)}
+    for item in rows:
+        days[int(item[1])] = (item[0], item[2] if len(item) > 2 else None)
+    with closing(open_cost_store(get_run_context().cost_store.store_file)) as connection, connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO daily_cost (scope, usage_date, cost, currency, fetched_at) VALUES (?, ?, ?, ?, ?)",
+            [(scope, usage_date, cost, currency, fetched_at) for usage_date, (cost, currency) in days.items()],
+        )
+        connection.execute("DELETE FROM daily_cost WHERE scope = ? AND usage_date < ?", (scope, get_usage_date(first_day)))
+        stored_rows = connection.execute(
+            "SELECT cost, usage_date, currency FROM daily_cost WHERE scope = ? AND cost IS NOT NULL ORDER BY usage_date", (scope,)
+        ).fetchall()
+    return [list(row) for row in stored_rows]
+
+def get_stored_cost_data(scope):
+    """Return the daily cost of the last 30 days of a scope from the cost store, querying only the days that are missing or not final yet."""
     cet = pytz.timezone("CET")
-    now_cet = datetime.now(cet)
-
+    first_day, last_day = get_cost_history_days()
+    query_start = get_stored_cost_query_start(scope, first_day, last_day)
+
+    cost_data = query_cost_data(scope, cet.localize(datetime.combine(query_start, datetime.min.time())).isoformat(), datetime.now(cet).isoformat())
+    logger.info(f"Queried {(last_day - query_start).days + 1} of {COST_HISTORY_DAYS + 1} days of cost data for scope {scope}")
+    tc.track_metric("CostDaysQueried", (last_day - query_start).days + 1, properties={"Scope": scope})
+    return SimpleNamespace(rows=store_cost_rows(scope, cost_data.rows, query_start, first_day, last_day))
+
+def get_cost_column_indexes(cost_data, *dimensions):
+    """Return the indexes of the cost, usage date and grouping dimension columns of a cost query result."""
+    names = [column.name.lower() for column in cost_data.columns]
+    cost_index = next((names.index(name) for name in ("totalcost", "pretaxcost") if name in names), 0)
+    return [cost_index, names.index("usagedate")] + [names.index(dimension.lower()) for dimension in dimensions]
+
+def split_cost_data_by_subscription(cost_data):
+    """Split the rows of a cost query grouped by SubscriptionId into (cost, usage date, currency) rows per lower-cased subscription id."""
+    names = [column.name.lower() for column in cost_data.columns]
+    cost_index, date_index, subscription_index = get_cost_column_indexes(cost_data, "SubscriptionId")
+    currency_index = names.index("currency") if "currency" in names else None
+    rows_by_subscription = defaultdict(list)
     for item in cost_data.rows:
+        rows_by_subscription[str(item[subscription_index]).lower()].append(
+            [item[cost_index], item[date_index], item[currency_index] if currency_index is not None else None]
+        )
+    return rows_by_subscription
+
+def list_cost_scope_subscriptions(cost_scope, client):
+    """Return the lower-cased ids of the subscriptions under a management group or billing account scope."""
+    parts = cost_scope.strip("/").split("/")
+    scope_type = "/".join(parts[-3:-1]).lower()
+    if scope_type not in COST_SCOPE_SUBSCRIPTION_LISTS:
+        raise ValueError(f"Unsupported cost scope: {cost_scope}")
+    path, api_version = COST_SCOPE_SUBSCRIPTION_LISTS[scope_type]
+    subscription_ids = set()
+    next_link = f"https://management.azure.com/{cost_scope.strip('/')}/{path}?api-version={api_version}"
+    while next_link:
+        response = client._send_request(HttpRequest("GET", next_link))
+        response.raise_for_status()
+        page = json.loads(response.text())
+        for item in page.get("value", []):
+            if item.get("type", "").lower().endswith("/subscriptions"):
+                # Management group descendants, which also list the child management groups
+                subscription_ids.add(item["name"].lower())
+            elif item.get("properties", {}).get("subscriptionId"):
+                subscription_ids.add(item["properties"]["subscriptionId"].lower())
+        next_link = page.get("nextLink")
+    return subscription_ids
+
+def query_grouped_cost_data(cost_scope, subscription_ids):
+    """Query the daily cost of the subscriptions under a billing account or management group scope at once, returning it per subscription scope."""
+    cet = pytz.timezone("CET")
+    first_day, last_day = get_cost_history_days()
+    cost_management_client = CostManagementClient(credential, **get_client_kwargs())
+    try:
+        scope_subscription_ids = list_cost_scope_subscriptions(cost_scope, cost_management_client)
+    except Exception as e:
+        logger.warning(f"Failed to list the subscriptions under scope {cost_scope}, falling back to one query per subscription: {e}")
+        return {}
+    # Subscriptions outside the scope are missing from its result like subscriptions without usage, they are queried on their own
+    outside_scope = [subscription_id for subscription_id in subscription_ids if subscription_id.lower() not in scope_subscription_ids]
+    if outside_scope:
+        logger.warning(f"{len(outside_scope)} subscription(s) are not under scope {cost_scope} and are queried on their own: {outside_scope}")
+    subscription_ids = [subscription_id for subscription_id in subscription_ids if subscription_id.lower() in scope_subscription_ids]
+    if not subscription_ids:
+        return {}
+    scopes = [f"/subscriptions/{subscription_id}" for subscription_id in subscription_ids]
+    # With a cost store the query starts at the earliest day any subscription is missing
+    query_start = min(get_stored_cost_query_start(scope, first_day, last_day) for scope in scopes) if get_run_context().cost_store and scopes else first_day
+    try:
+        cost_data = query_cost_data(
+            cost_scope,
+            cet.localize(datetime.combine(query_start, datetime.min.time())).isoformat(),
+            datetime.now(cet).isoformat(),
+            group_by=["SubscriptionId"],
+            cost_management_client=cost_management_client,
+        )
+    except Exception as e:
+        # e.g. the principal has no Cost Management reader role on the higher scope
+        logger.warning(f"Failed to query cost data at scope {cost_scope}, falling back to one query per subscription: {e}")
+        return {}
+    rows_by_subscription = split_cost_data_by_subscription(cost_data)
+    grouped_cost_data = {}
+    for subscription_id, scope in zip(subscription_ids, scopes):
+        # Subscriptions under the scope without usage have no rows in the grouped result
+        rows = rows_by_subscription.get(subscription_id.lower(), [])
+        if get_run_context().cost_store:
+            rows = store_cost_rows(scope, rows, query_start, first_day, last_day)
+        grouped_cost_data[scope.lower()] = SimpleNamespace(rows=rows)
+    logger.info(f"Queried cost data of {len(scopes)} subscription(s) at scope {cost_scope} in one query")
+    tc.track_metric("CostDaysQueried", (last_day - query_start).days + 1, properties={"Scope": cost_scope})
+    return grouped_cost_data
+
+def get_cost_columns(rows):
+    """Return the cost and YYYYMMDD usage date columns of (cost, usage date, ...) rows as typed arrays."""
+    try:
+        costs = np.fromiter((item[0] for item in rows), dtype=np.float64, count=len(rows))
+        usage_dates = np.fromiter((item[1] for item in rows), dtype=np.int64, count=len(rows))
+    except (TypeError, ValueError):
+        # Rows with missing or malformed values are coerced and dropped instead of failing the whole series
+        frame = pd.DataFrame([item[:2] for item in rows], columns=["cost", "usage_date"])
+        costs = pd.to_numeric(frame["cost"], errors="coerce").to_numpy(dtype=np.float64)
+        usage_dates = pd.to_numeric(frame["usage_date"], errors="coerce").to_numpy(dtype=np.float64)
+        valid = ~(np.isnan(costs) | np.isnan(usage_dates))
+        if not valid.all():
+            logger.error(f"Skipping {(~valid).sum()} cost row(s) with a missing or malformed cost or date")
+        costs, usage_dates = costs[valid], usage_dates[valid].astype(np.int64)
+    return costs, usage_dates
+
+def get_daily_costs(rows, today):
+    """Sum (cost, YYYYMMDD usage date, ...) rows per day before today into a daily cost frame indexed by CET date."""
+    costs, usage_dates = get_cost_columns(rows)
+    before_today = usage_dates < int(today.strftime("%Y%m%d"))
+    daily = pd.Series(costs[before_today]).groupby(usage_dates[before_today]).sum()
+
+    # Only the distinct days are parsed, not every row
+    dates = pd.to_datetime(daily.index.astype(str), format="%Y%m%d", errors="coerce")
+    if dates.isna().any():
+        logger.error(f"Skipping cost of unparsable date(s): {list(daily.index[dates.isna()])}")
+    df = pd.DataFrame({"cost": daily.to_numpy()[~dates.isna()]}, index=dates[~dates.isna()].tz_localize("UTC").tz_convert(pytz.timezone("CET")))
+    df.index.name = "date"
+    return df.asfreq("D")
+
+def get_resource_scopes(resource_id):
+    """Return the lower-cased subscription id and resource group id of a lower-cased resource id."""
+    parts = resource_id.split("/")
+    subscription_id = parts[2] if len(parts) > 2 and parts[1] == "subscriptions" else ""
+    resource_group_id = "/".join(parts[:5]) if len(parts) > 4 and parts[3] == "resourcegroups" else ""
+    return subscription_id, resource_group_id
+
+class CostCube:
+    """Daily cost per subscription, resource group, resource id and meter category with dictionary-encoded dimensions."""
+
+    def __init__(self, usage_dates, costs, codes, values, index=None):
+        self.usage_dates = usage_dates
+        self.costs = costs
+        # Per dimension: the code of every row, the lower-cased value of every code and a hash index from value to code
+        self.codes = codes
+        self.values = values
+        self.index = index or {dimension: {value: code for code, value in enumerate(values[dimension])} for dimension in values}
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build a cube from (cost, YYYYMMDD usage date, resource id, meter category) rows."""
+        usage_dates = np.fromiter((item[1] for item in rows), dtype=np.int64, count=len(rows))
+        costs = np.fromiter((item[0] for item in rows), dtype=np.float64, count=len(rows))
+        codes, values = {}, {}
+        codes["resource_id"], values["resource_id"] = pd.factorize(np.array([str(item[2] or "").lower() for item in rows], dtype=object))
+        codes["meter_category"], values["meter_category"] = pd.factorize(np.array([str(item[3] or "").lower() for item in rows], dtype=object))
+        # The subscription and resource group are encoded once per distinct resource id and mapped onto the rows through its codes
+        scopes = [get_resource_scopes(resource_id) for resource_id in values["resource_id"]]
+        for position, dimension in enumerate(["subscription", "resource_group"]):
+            resource_codes, values[dimension] = pd.factorize(np.array([scope[position] for scope in scopes], dtype=object))
+            codes[dimension] = resource_codes[codes["resource_id"]]
+        return cls(usage_dates, costs, codes, values)
+
+    def get_totals(self, dimension):
+        """Return the total cost of every code of a dimension, summed in one vectorized pass on first use."""
+        with self.lock:
+            if dimension not in self.totals:
+                self.totals[dimension] = np.bincount(self.codes[dimension], weights=self.costs, minlength=len(self.values[dimension]))
+            return self.totals[dimension]
+
+    def get_cost(self, dimension, value):
+        """Return the total cost of one value of a dimension, e.g. of a resource group id."""
+        code = self.index[dimension].get(str(value).lower())
+        return 0.0 if code is None else float(self.get_totals(dimension)[code])
+
+    def get_resource_cost(self, resource_id):
+        """Return the total cost of a resource, or of all resources of a resource group for a resource group id."""
+        resource_id = str(resource_id or "").lower()
+        if resource_id in self.index["resource_id"]:
+            return self.get_cost("resource_id", resource_id)
+        return self.get_cost("resource_group", resource_id)
+
+    def slice(self, start_date=None, end_date=None, **values):
+        """Return the cube of the rows between two YYYYMMDD dates matching dimension values, e.g. meter_category="storage"."""
+        mask = np.ones(len(self.costs), dtype=bool)
+        if start_date is not None:
+            mask &= self.usage_dates >= start_date
+        if end_date is not None:
+            mask &= self.usage_dates <= end_date
+        for dimension, value in values.items():
+            mask &= self.codes[dimension] == self.index[dimension].get(str(value).lower(), -1)
+        # The dictionaries are shared, so codes stay comparable between a cube and its slices
+        return CostCube(self.usage_dates[mask], self.costs[mask], {dimension: codes[mask] for dimension, codes in self.codes.items()}, self.values, self.index)
+
+    def rollup(self, *dimensions):
+        """Sum the cost per combination of dimension values into a Series, "usage_date" rolls up per day."""
+        keys = [self.usage_dates if dimension == "usage_date" else self.codes[dimension] for dimension in dimensions]
+        totals = pd.Series(self.costs).groupby(keys).sum()
+        # Only the codes of the groups are decoded, not those of every row
+        levels = [
+            totals.index.get_level_values(position) if dimension == "usage_date" else self.values[dimension][totals.index.get_level_values(position)]
+            for position, dimension in enumerate(dimensions)
+        ]
+        totals.index = pd.MultiIndex.from_arrays(levels, names=dimensions) if len(dimensions) > 1 else pd.Index(levels[0], name=dimensions[0])
+        return totals
+
+def query_cost_cube(scopes):
+    """Query the daily cost per resource id and meter category of scopes and build the cost cube of the run from it."""
+    cost_management_client = CostManagementClient(credential, **get_client_kwargs())
+    rows = []
+    for scope in scopes:
         try:
-            date_str = str(item[1])
-            date = pd.to_datetime(date_str, format="%Y%m%d")
-            date = date.tz_localize("UTC").tz_convert(cet)
-
-            if date.date() < now_cet.date():
-                data.append({"date": date, "cost": item[0]})
+            cost_data = query_cost_data(scope, group_by=["ResourceId", "MeterCategory"], cost_management_client=cost_management_client)
         except Exception as e:
-            logger.error(f"Error parsing date: {e}, Item: {item}")
-
-    df = pd.DataFrame(data)
-    df["date"] = pd.to_datetime(df["date"])
-    df.set_index("date", inplace=True)
-    df = df.asfreq("D")
-
-    for _, row in df.iterrows():
-        logger.info(f"Date: {row.name.date()}, Cost: {row['cost']}")
+            logger.error(f"Failed to query cost data per resource for scope {scope}: {e}")
+            continue
+        indexes = get_cost_column_indexes(cost_data, "ResourceId", "MeterCategory")
+        rows.extend([item[index] for index in indexes] for item in cost_data.rows)
+    cube = CostCube.from_rows(rows)
+    logger.info(f"Built cost cube of {len(rows)} row(s) and {len(cube.values['resource_id'])} resource(s) from {len(scopes)} scope(s)")
+    tc.track_metric("CostCubeRows", len(rows))
+    return cube
+
+def analyze_cost_data(cost_data, subscription_id, summary_reports, daily_costs=None):
+    """Analyze cost data until yesterday, detect trends, generate reports and collect the daily series for anomaly detection."""
+    now_cet = get_reference_time(pytz.timezone("CET"))
+    df = get_daily_costs(cost_data.rows, now_cet.date())
+    if df.empty:
+        logger.warning(f"No cost data until yesterday for subscription {subscription_id}")
+        return
+
+    for date, cost in df["cost"].items():
+        logger.info(f"Date: {date.date()}, Cost: {cost}")
         tc.track_metric(
-            "DailyCost", row["cost"], properties={"Date": row.name.date().isoformat()}
+            "DailyCost", cost, properties={"Date": date.date().isoformat()}
         )
 
     trend_analysis(df, subscription_id)
-    detect_anomalies_isolation_forest(df, subscription_id)
     generate_summary_report(df, subscription_id, summary_reports)
+    if daily_costs is not None:
+        # Anomalies of all series of the run are detected at once by detect_cost_anomalies
+        daily_costs.append(pd.DataFrame({"scope": subscription_id, "date": df.index.tz_localize(None).normalize(), "cost": df["cost"].to_numpy()}))
 
 def trend_analysis(df, subscription_id):
     """Analyze cost trends over time and plot the trend."""
-    df["cost"].plot(
-        title=f"Cost Trend Over Time for Subscription {subscription_id}",
-        figsize=(10, 5),
-    )
-    plt.xlabel("Date")
-    plt.ylabel("Cost")
-    plt.savefig(f"cost_trend_{subscription_id}.png")
-    plt.close()
+    with plot_lock:
+        df["cost"].plot(
+            title=f"Cost Trend Over Time for Subscription {subscription_id}",
+            figsize=(10, 5),
+        )
+        plt.xlabel("Date")
+        plt.ylabel("Cost")
+        plt.savefig(f"cost_trend_{subscription_id}.png")
+        plt.close()
     logger.info(f"Trend analysis plot saved as cost_trend_{subscription_id}.png.")
     tc.track_event("TrendAnalysisCompleted", {"SubscriptionId": subscription_id})
 
-def detect_anomalies_isolation_forest(df, subscription_id):
-    """Detect anomalies in the cost data using Isolation Forest."""
-    model = IsolationForest(contamination=0.025)
-    df["anomaly"] = model.fit_predict(df[["cost"]])
-    anomalies = df[df["anomaly"] == -1]
-
-    if not anomalies.empty:
-        for _, row in anomalies.iterrows():
-            tc.track_event(
-                "AnomalyDetectedIsolationForest",
-                {
-                    "SubscriptionId": subscription_id,
-                    "Date": row.name.date().isoformat(),
-                    "Cost": row["cost"],
-                },
-            )
-            table = PrettyTable()
-            table.field_names = ["Subscription ID", "Anomaly Detected", "Date", "Cost"]
-            table.add_row(
-                [
-                    subscription_id,
-                    "Isolation Forest Algorithm",
-                    row.name.date().isoformat(),
-                    f'{row["cost"]:.2f}',
-                ]
-            )
-            print(colored(table, "red"))
-    else:
-        logger.info(
-            f"No anomalies detected in cost data for subscription {subscription_id} using Isolation Forest."
-        )
-        tc.track_event(
-            "NoAnomaliesDetectedIsolationForest", {"SubscriptionId": subscription_id}
-        )
+def get_resource_group_daily_costs(cube, today):
+    """Return the daily cost of every resource group of a cost cube before today as a long (scope, date, cost) frame."""
+    cube = cube.slice(end_date=int((today - timedelta(days=1)).strftime("%Y%m%d")))
+    if not len(cube.costs):
+        return pd.DataFrame(columns=["scope", "date", "cost"])
+    # Days without usage have no rows in the cube, they are filled with zero cost
+    totals = cube.rollup("resource_group", "usage_date").unstack(fill_value=0).stack()
+    frame = totals.reset_index(name="cost").rename(columns={"resource_group": "scope", "usage_date": "date"})
+    frame["date"] = pd.to_datetime(frame["date"].astype(str), format="%Y%m%d")
+    return frame[frame["scope"] != ""]
+
+def detect_cost_anomalies(daily_costs):
+    """Score the days of every series of a long (scope, date, cost) frame at once by modified z-score and return the anomalous days."""
+    frame = daily_costs.dropna(subset=["cost"])
+    by_scope = frame.groupby("scope", sort=False)["cost"]
+    median = by_scope.transform("median")
+    deviation = (frame["cost"] - median).abs()
+    deviation_by_scope = deviation.groupby(frame["scope"], sort=False)
+    mad = deviation_by_scope.transform("median")
+    # Series flat on most days have no median absolute deviation, their deviations are scaled by the mean absolute deviation instead
+    scale = (1.4826 * mad).where(mad > 0, 1.2533 * deviation_by_scope.transform("mean"))
+    score = (deviation / scale.where(scale > 0)).fillna(0)
+    anomalous = (score > ANOMALY_SCORE_THRESHOLD) & (by_scope.transform("size") >= ANOMALY_MIN_DAYS)
+    anomalies = frame[anomalous].assign(median=median[anomalous], score=score[anomalous])
+    return anomalies.sort_values("score", ascending=False, ignore_index=True)
 
 def generate_summary_report(df, subscription_id, summary_reports):
     """Generate a summary report of the cost data."""
@@ -367,10 +1253,7 @@ def evaluate_filters(resource, filters):
 
 def is_vm_stopped(vm):
     """Check if a VM is stopped (deallocated)."""
-    resource_group_name = vm.id.split("/")[4]
-    vm_instance_view = compute_client.virtual_machines.instance_view(resource_group_name, vm.name)
-    statuses = vm_instance_view.statuses
-    return any(status.code == 'PowerState/deallocated' for status in statuses)
+    return get_power_state(vm) == 'PowerState/deallocated'
 
 def evaluate_exclusions(resource, exclusions):
     """Evaluate if a resource meets any of the exclusion criteria."""
@@ -384,7 +1267,11 @@ def evaluate_exclusions(resource, exclusions):
 def last_used_filter(resource, days, threshold):
     """Check if a resource was last used within a specified number of days and meets the CPU threshold."""
     last_used_date, avg_cpu = get_last_used_date(resource, days, threshold)
-    if (datetime.now(timezone.utc) - last_used_date).days <= days and avg_cpu < threshold:
+    return is_idle(resource, last_used_date, avg_cpu, days, threshold)
+
+def is_idle(resource, last_used_date, avg_cpu, days, threshold):
+    """Check a (last used date, average CPU usage) tuple against the last_used filter settings."""
+    if (get_reference_time() - last_used_date).days <= days and avg_cpu < threshold:
         logger.info(f"Resource {resource.name} was last used within {days} days with average CPU usage {avg_cpu:.2f}% which is below the threshold of {threshold}%.")
         return True
     logger.info(f"Resource {resource.name} was either not used within {days} days or its average CPU usage {avg_cpu:.2f}% is above the threshold of {threshold}%.")
@@ -393,35 +1280,65 @@ def last_used_filter(resource, days, threshold):
 def unattached_filter(resource):
     """Check if a resource is unattached."""
     logger.info(f"Checking if resource {resource.name} is unattached.")
-    
-    # Check if the resource is a Public IP Address
-    if isinstance(resource, network_client.public_ip_addresses.models.PublicIPAddress):
-        if resource.ip_configuration is None:
-            # Check for associations with Load Balancers and NAT Gateways
-            associated_lb = network_client.load_balancers.list_all()
-            for lb in associated_lb:
-                for frontend_ip in lb.frontend_ip_configurations:
-                    if frontend_ip.public_ip_address and frontend_ip.public_ip_address.id == resource.id:
-                        return False
-            associated_nat_gateways = network_client.nat_gateways.list_all()
-            for nat_gateway in associated_nat_gateways:
-                for public_ip in nat_gateway.public_ip_addresses:
-                    if public_ip.id == resource.id:
-                        return False
-            return True
-        else:
-            return False
-    
-    # Check if the resource is a Network Interface (NIC)
-    elif isinstance(resource, network_client.network_interfaces.models.NetworkInterface):
-        # Check if the NIC is attached to a private endpoint
-        if resource.private_endpoint:
-            logger.info(f"NIC {resource.name} is attached to a private endpoint and will not be deleted.")
-            return False
-        return not resource.virtual_machine
-    
-    # Default case: check if the resource is managed by another resource
-    return resource.managed_by is None
+    attached_to = get_attachments(resource, get_reference_graph())
+    if attached_to:
+        logger.info(f"Resource {resource.name} is attached to {', '.join(sorted(resource_id.split('/')[-1] for resource_id in attached_to))}.")
+    return not attached_to
+
+def get_parent_resource_id(resource_id):
+    """Return the id of the resource owning a sub-resource such as an IP configuration."""
+    return "/".join(resource_id.split("/")[:9])
+
+def get_reference_edges(resource):
+    """Yield the (attached resource id, attached to resource id) edges described by the properties of a resource."""
+    resource_id = resource.id.lower()
+    # Public IP bound to a NIC, load balancer or gateway IP configuration
+    if getattr(resource, "ip_configuration", None):
+        yield resource_id, get_parent_resource_id(resource.ip_configuration.id.lower())
+    if getattr(resource, "nat_gateway", None):
+        yield resource_id, resource.nat_gateway.id.lower()
+    # NIC attached to a VM or a private endpoint
+    if getattr(resource, "virtual_machine", None):
+        yield resource_id, resource.virtual_machine.id.lower()
+    if getattr(resource, "private_endpoint", None):
+        yield resource_id, resource.private_endpoint.id.lower()
+    # Public IPs used by NIC, load balancer and application gateway IP configurations
+    for ip_configuration in (getattr(resource, "ip_configurations", None) or []) + (getattr(resource, "frontend_ip_configurations", None) or []):
+        if ip_configuration.public_ip_address:
+            yield ip_configuration.public_ip_address.id.lower(), resource_id
+    # Public IPs used by a NAT gateway
+    for public_ip in getattr(resource, "public_ip_addresses", None) or []:
+        yield public_ip.id.lower(), resource_id
+    # Disk attached to a VM, or any resource managed by another one
+    if getattr(resource, "managed_by", None):
+        yield resource_id, resource.managed_by.lower()
+
+def build_reference_graph(resources):
+    """Index which resources every resource is attached to, by lower-cased resource id."""
+    reference_graph = defaultdict(set)
+    for resource in resources:
+        for attached_id, attached_to_id in get_reference_edges(resource):
+            reference_graph[attached_id].add(attached_to_id)
+    return reference_graph
+
+def get_reference_graph():
+    """Return the reference graph of the current subscription, building it once from the inventory on first use."""
+    clients = get_clients()
+    with clients.inventory_lock:
+        type_lock = clients.inventory_type_locks.setdefault("reference_graph", threading.Lock())
+    with type_lock:
+        if clients.reference_graph is None:
+            clients.reference_graph = build_reference_graph(
+                resource for resource_type in REFERENCE_GRAPH_TYPES for resource in list_resources(resource_type)
+            )
+        return clients.reference_graph
+
+def get_attachments(resource, reference_graph):
+    """Return the ids of the resources a resource is attached to."""
+    # The resource's own properties are checked as well in case it was created after the graph was built
+    return reference_graph.get(resource.id.lower(), set()) | {
+        attached_to_id for attached_id, attached_to_id in get_reference_edges(resource) if attached_id == resource.id.lower()
+    }
 
 def tag_filter(resource, key, value):
     """Check if a resource has a specific tag."""
@@ -447,26 +1364,172 @@ def get_last_used_date(resource, days, threshold=5):
     Returns:
     - A tuple of (last used date, average CPU usage).
     """
-    resource_id = resource.id
-    end_time = datetime.now(timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z")
-    start_time = (datetime.now(timezone.utc) - timedelta(days=days)).replace(microsecond=0).isoformat().replace("+00:00", "Z")
-
-    # Initialize monitor client
-    monitor_client = MonitorManagementClient(credential, resource_id.split('/')[2])
-    
-    # Format timespan in ISO 8601 format
-    timespan = f"{start_time}/{end_time}"
-
-    # Query CPU usage metrics
-    metrics_data = monitor_client.metrics.list(
-        resource_id,
-        timespan=timespan,
-        interval='PT1H',
-        metricnames='Percentage CPU',
-        aggregation='Average',
+    cpu_usage = get_clients().cpu_usage.get((resource.id.lower(), days))
+    if cpu_usage is None:
+        # VMs that were not prefetched are queried on their own
+        end_time = datetime.now(timezone.utc).replace(microsecond=0)
+        start_time = end_time - timedelta(days=days)
+        cpu_points = query_cpu_usage([resource], start_time, end_time)
+        cpu_usage = start_time.isoformat().replace("+00:00", "Z"), cpu_points.get(resource.id.lower(), [])
+    start_time, cpu_points = cpu_usage
+    return summarize_cpu_usage(resource, cpu_points, days, threshold, start_time)
+
+def get_metrics_client(region):
+    """Return the batch metrics client of a region for the current subscription."""
+    clients = get_clients()
+    with clients.inventory_lock:
+        if region not in clients.metrics_clients:
+            clients.metrics_clients[region] = MetricsClient(METRICS_ENDPOINT.format(region=region), credential, **get_client_kwargs())
+        return clients.metrics_clients[region]
+
+def query_cpu_usage(resources, start_time, end_time):
+    """Query the hourly Percentage CPU of VMs of one subscription and region in a single batch metrics call."""
+    results = get_metrics_client(resources[0].location).query_resources(
+        resource_ids=[resource.id for resource in resources],
+        metric_namespace="Microsoft.Compute/virtualMachines",
+        metric_names=["Percentage CPU"],
+        timespan=(start_time, end_time),
+        granularity=timedelta(hours=1),
+        aggregations=["Average"],
     )
-
-    cpu_usages = [data.average for metric in metrics_data.value for data in metric.timeseries[0].data if data.average is not None]
+    cpu_points = {}
+    for result in results:
+        for metric in result.metrics:
+            # Metric ids are the resource id followed by /providers/Microsoft.Insights/metrics/<name>
+            resource_id = metric.id.lower().split("/providers/microsoft.insights/")[0]
+            cpu_points[resource_id] = [(data.timestamp, data.average) for data in metric.timeseries[0].data] if metric.timeseries else []
+    return cpu_points
+
+def prefetch_cpu_usage(resources, days):
+    """Fetch the CPU usage of VMs ahead of the last_used filter, batching them per subscription and region."""
+    clients = get_clients()
+    metrics_cache = get_run_context().metrics_cache
+    # Policies evaluated concurrently share the prefetched metrics instead of querying them twice
+    with clients.cpu_usage_lock:
+        resources = [resource for resource in resources if (resource.id.lower(), days) not in clients.cpu_usage]
+        if not resources:
+            return
+
+        end_time = datetime.now(timezone.utc).replace(microsecond=0)
+        start_time = end_time - timedelta(days=days)
+        cpu_series = load_cpu_series(metrics_cache.cache_file, [resource.id.lower() for resource in resources]) if metrics_cache else {}
+
+        # VMs with a cached series only query the hours missing since the last run
+        resources_by_query = defaultdict(list)
+        for resource in resources:
+            query_start = get_cpu_series_query_start(cpu_series.get(resource.id.lower()), start_time)
+            resources_by_query[(resource.id.split("/")[2].lower(), resource.location, query_start)].append(resource)
+        batches = [
+            (query_start, query_resources[offset:offset + METRICS_BATCH_SIZE])
+            for (_, _, query_start), query_resources in resources_by_query.items()
+            for offset in range(0, len(query_resources), METRICS_BATCH_SIZE)
+        ]
+
+        prefetch_start = time.perf_counter()
+        updated_series = {}
+        with ThreadPoolExecutor(max_workers=get_run_context().max_parallel_metric_queries) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, query_cpu_usage, batch, query_start, end_time) for query_start, batch in batches]
+            for (query_start, batch), future in zip(batches, futures):
+                try:
+                    cpu_points = future.result()
+                except Exception as e:
+                    # VMs of a failed batch are queried again one by one by get_last_used_date
+                    logger.error(f"Failed to query CPU usage of {len(batch)} VMs in {batch[0].location}: {e}")
+                    continue
+                for resource in batch:
+                    resource_id = resource.id.lower()
+                    points = cpu_points.get(resource_id, [])
+                    if metrics_cache:
+                        retention_days = max(metrics_cache.retention_days, days)
+                        updated_series[resource_id] = merge_cpu_series(cpu_series.get(resource_id), points, query_start, end_time, end_time - timedelta(days=retention_days))
+                        points = get_cpu_series_points(updated_series[resource_id], start_time)
+                    clients.cpu_usage[(resource_id, days)] = (start_time.isoformat().replace("+00:00", "Z"), points)
+        if metrics_cache:
+            store_cpu_series(metrics_cache.cache_file, updated_series, end_time - timedelta(days=metrics_cache.retention_days))
+        incremental = sum(len(batch) for query_start, batch in batches if query_start > start_time)
+        logger.info(f"Queried CPU usage of {len(resources)} VMs ({incremental} incrementally) in {len(batches)} batch(es) for subscription {clients.subscription_id} in {time.perf_counter() - prefetch_start:.2f} seconds")
+
+def get_hour(timestamp):
+    """Return the number of hours since the epoch of a timezone-aware datetime."""
+    return int(timestamp.timestamp() // 3600)
+
+def open_metrics_cache(cache_file):
+    """Open the on-disk CPU series cache, creating its table on first use."""
+    os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+    connection = sqlite3.connect(cache_file, timeout=30)
+    # One hourly float32 series per VM starting at start_hour, hours without data are stored as NaN
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS cpu_series (
+            resource_id TEXT PRIMARY KEY,
+            start_hour INTEGER NOT NULL,
+            end_hour INTEGER NOT NULL,
+            samples BLOB NOT NULL
+        )
+        """
+    )
+    return connection
+
+def load_cpu_series(cache_file, resource_ids):
+    """Return the cached (start hour, samples) CPU series of VMs, indexed by lower-cased resource id."""
+    cpu_series = {}
+    with closing(open_metrics_cache(cache_file)) as connection:
+        for offset in range(0, len(resource_ids), RESOURCE_GRAPH_ID_BATCH_SIZE):
+            ids = resource_ids[offset:offset + RESOURCE_GRAPH_ID_BATCH_SIZE]
+            rows = connection.execute(
+                f"SELECT resource_id, start_hour, samples FROM cpu_series WHERE resource_id IN ({', '.join('?' * len(ids))})", ids
+            )
+            for resource_id, start_hour, blob in rows:
+                samples = array("f")
+                samples.frombytes(blob)
+                cpu_series[resource_id] = (start_hour, samples)
+    return cpu_series
+
+def store_cpu_series(cache_file, cpu_series, retention_start):
+    """Write updated CPU series to the cache and evict the series that ended before the retention window."""
+    with closing(open_metrics_cache(cache_file)) as connection, connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO cpu_series (resource_id, start_hour, end_hour, samples) VALUES (?, ?, ?, ?)",
+            [(resource_id, start_hour, start_hour + len(samples), samples.tobytes()) for resource_id, (start_hour, samples) in cpu_series.items()],
+        )
+        connection.execute("DELETE FROM cpu_series WHERE end_hour <= ?", (get_hour(retention_start),))
+
+def get_cpu_series_query_start(series, start_time):
+    """Return where the metrics query of a VM should start given its cached CPU series."""
+    if series is None:
+        return start_time
+    start_hour, samples = series
+    end_hour = start_hour + len(samples)
+    if start_hour > get_hour(start_time) or end_hour <= get_hour(start_time):
+        return start_time
+    return max(start_time, datetime.fromtimestamp((end_hour - CPU_SERIES_OVERLAP_HOURS) * 3600, timezone.utc))
+
+def merge_cpu_series(series, cpu_points, query_start, end_time, retention_start):
+    """Merge freshly queried CPU points into a cached series, dropping the hours before the retention window."""
+    values = {}
+    start_hour = get_hour(query_start)
+    if series is not None:
+        cached_start_hour, samples = series
+        values = {cached_start_hour + offset: sample for offset, sample in enumerate(samples) if not math.isnan(sample)}
+        start_hour = min(start_hour, cached_start_hour)
+    for time_stamp, average in cpu_points:
+        if average is not None:
+            values[get_hour(time_stamp)] = average
+    start_hour = max(start_hour, get_hour(retention_start))
+    return start_hour, array("f", (values.get(hour, math.nan) for hour in range(start_hour, get_hour(end_time) + 1)))
+
+def get_cpu_series_points(series, start_time):
+    """Return the (time stamp, average) points of a CPU series from a start time on."""
+    start_hour, samples = series
+    return [
+        (datetime.fromtimestamp((start_hour + offset) * 3600, timezone.utc), None if math.isnan(sample) else sample)
+        for offset, sample in enumerate(samples)
+        if start_hour + offset >= get_hour(start_time)
+    ]
+
+def summarize_cpu_usage(resource, cpu_points, days, threshold, start_time):
+    """Compute the (last used date, average CPU usage) tuple of a VM from its hourly (time stamp, average) Percentage CPU points."""
+    cpu_usages = [average for _, average in cpu_points if average is not None]
 
     if not cpu_usages:
         logger.info(f"No CPU usage data available for VM: {resource.name} in the last {days} days.")
@@ -483,9 +1546,9 @@ def get_last_used_date(resource, days, threshold=5):
         return datetime.fromisoformat(start_time.replace("Z", "+00:00")), average_cpu_usage
 
     # If the VM was used, find the last time it was above the threshold
-    for data in reversed(metrics_data.value[0].timeseries[0].data):
-        if data.average and data.average >= threshold:
-            return data.time_stamp, average_cpu_usage
+    for time_stamp, average in reversed(cpu_points):
+        if average and average >= threshold:
+            return time_stamp, average_cpu_usage
 
     # If all CPU usage values are below the threshold, return the start_time
     return datetime.fromisoformat(start_time.replace("Z", "+00:00")), average_cpu_usage
@@ -520,9 +1583,9 @@ def apply_actions(resource, actions, status_log, dry_run, subscription_id):
                 )
                 logger.info(f"Action stop applied to VM {resource.name} with status: {status}")
             elif action_type == "downgrade_disks":
-                if isinstance(resource, compute_client.virtual_machines.models.VirtualMachine):
+                if isinstance(resource, get_clients().compute_client.virtual_machines.models.VirtualMachine):
                     status, message = downgrade_disks_of_vm(resource, status_log, dry_run, subscription_id)
-                elif isinstance(resource, compute_client.disks.models.Disk):
+                elif isinstance(resource, get_clients().compute_client.disks.models.Disk):
                     status, message = downgrade_disk(resource)
                 status_log.append(
                     {
@@ -535,7 +1598,7 @@ def apply_actions(resource, actions, status_log, dry_run, subscription_id):
                 )
                 logger.info(f"Action downgrade_disks applied to {resource.name} with status: {status} and message: {message}")
             elif action_type == "delete":
-                if isinstance(resource, compute_client.disks.models.Disk):
+                if isinstance(resource, get_clients().compute_client.disks.models.Disk):
                     status, message = delete_disk(resource)
                     status_log.append(
                         {
@@ -547,7 +1610,7 @@ def apply_actions(resource, actions, status_log, dry_run, subscription_id):
                         }
                     )
                     logger.info(f"Action delete applied to Disk {resource.name} with status: {status} and message: {message}")
-                elif isinstance(resource, resource_client.resource_groups.models.ResourceGroup):
+                elif isinstance(resource, get_clients().resource_client.resource_groups.models.ResourceGroup):
                     status, message = delete_resource_group(resource)
                     status_log.append(
                         {
@@ -559,7 +1622,7 @@ def apply_actions(resource, actions, status_log, dry_run, subscription_id):
                         }
                     )
                     logger.info(f"Action delete applied to Resource Group {resource.name} with status: {status} and message: {message}")
-                elif isinstance(resource, network_client.public_ip_addresses.models.PublicIPAddress):
+                elif isinstance(resource, get_clients().network_client.public_ip_addresses.models.PublicIPAddress):
                     status, message = delete_public_ip(resource)
                     status_log.append(
                         {
@@ -571,7 +1634,7 @@ def apply_actions(resource, actions, status_log, dry_run, subscription_id):
                         }
                     )
                     logger.info(f"Action delete applied to Public IP {resource.name} with status: {status} and message: {message}")
-                elif isinstance(resource, network_client.network_interfaces.models.NetworkInterface):
+                elif isinstance(resource, get_clients().network_client.network_interfaces.models.NetworkInterface):
                     status, message = delete_network_interface(resource)
                     status_log.append(
                         {
@@ -583,11 +1646,11 @@ def apply_actions(resource, actions, status_log, dry_run, subscription_id):
                         }
                     )
                     logger.info(f"Action delete applied to Network Interface {resource.name} with status: {status} and message: {message}")
-                elif isinstance(resource, network_client.application_gateways.models.ApplicationGateway):
-                    status, message = delete_application_gateway(network_client, resource, status_log, dry_run)
+                elif isinstance(resource, get_clients().network_client.application_gateways.models.ApplicationGateway):
+                    status, message = delete_application_gateway(get_clients().network_client, resource, status_log, dry_run)
                     logger.info(f"Action delete applied to Application Gateway {resource.name} with status: {status} and message: {message}")
             elif action_type == "update_sku":
-                if isinstance(resource, storage_client.storage_accounts.models.StorageAccount):
+                if isinstance(resource, get_clients().storage_client.storage_accounts.models.StorageAccount):
                     status, message = update_storage_account_sku(resource, action["sku"])
                     status_log.append(
                         {
@@ -608,7 +1671,7 @@ def delete_network_interface(nic):
     try:
         logger.info(f"Deleting Network Interface: {nic.name}")
         resource_group_name = nic.id.split("/")[4]
-        async_delete = network_client.network_interfaces.begin_delete(resource_group_name, nic.name)
+        async_delete = get_clients().network_client.network_interfaces.begin_delete(resource_group_name, nic.name)
         async_delete.result()  # Wait for the operation to complete
         tc.track_event("NetworkInterfaceDeleted", {"NetworkInterfaceName": nic.name})
         return "Success", "Network Interface deleted successfully."
@@ -623,16 +1686,14 @@ def stop_vm(vm):
         logger.info(f"Checking status of VM: {vm.name}")
         resource_group_name = vm.id.split("/")[4]
         
-        instance_view = compute_client.virtual_machines.instance_view(resource_group_name, vm.name)
-        statuses = instance_view.statuses
-        for status in statuses:
-            if "PowerState" in status.code and "deallocated" in status.code:
-                message = f"VM {vm.name} is already deallocated."
-                logger.info(message)
-                tc.track_event("VMAlreadyDeallocated", {"VMName": vm.name})
-                return "No Action", message
-        async_stop = compute_client.virtual_machines.begin_deallocate(resource_group_name, vm.name)
+        if is_vm_deallocated(vm):
+            message = f"VM {vm.name} is already deallocated."
+            logger.info(message)
+            tc.track_event("VMAlreadyDeallocated", {"VMName": vm.name})
+            return "No Action", message
+        async_stop = get_clients().compute_client.virtual_machines.begin_deallocate(resource_group_name, vm.name)
         async_stop.result()
+        get_power_states()[vm.id.lower()] = "PowerState/deallocated"
         tc.track_event("VMDeallocated", {"VMName": vm.name})
         return "Success", "VM deallocated successfully."
     except Exception as e:
@@ -647,11 +1708,12 @@ def downgrade_disk(disk):
 
     try:
         if disk.sku.name != StorageAccountTypes.standard_lrs:
-            disk.sku.name = StorageAccountTypes.standard_lrs
-            async_update = compute_client.disks.begin_create_or_update(resource_group_name, disk_name, disk)
-            async_update.result()
-
-            updated_disk = compute_client.disks.get(resource_group_name, disk_name)
+            # PATCH only the SKU; the poller returns the updated disk, so no read-back is needed
+            async_update = get_clients().compute_client.disks.begin_update(
+                resource_group_name, disk_name, DiskUpdate(sku=DiskSku(name=StorageAccountTypes.standard_lrs))
+            )
+            updated_disk = async_update.result()
+            disk.sku = updated_disk.sku
             if updated_disk.sku.name == StorageAccountTypes.standard_lrs:
                 logger.info(f"Successfully downgraded disk {disk_name} to Standard_LRS")
                 return "Success", f"Successfully downgraded disk {disk_name} to Standard_LRS"
@@ -665,96 +1727,90 @@ def downgrade_disk(disk):
         logger.error(f"Failed to downgrade disk {disk_name}: {e}")
         return "Failed", f"Failed to downgrade disk {disk_name}: {e}"
 
+def get_disk_index():
+    """Return the managed disks of the current subscription indexed by lower-cased disk id, built once from the disk inventory."""
+    clients = get_clients()
+    with clients.inventory_lock:
+        type_lock = clients.inventory_type_locks.setdefault("disk_index", threading.Lock())
+    with type_lock:
+        if clients.disk_index is None:
+            clients.disk_index = {disk.id.lower(): disk for disk in list_resources("azure.disk")}
+        return clients.disk_index
+
+def get_managed_disk(disk_id):
+    """Return a managed disk from the subscription disk index."""
+    disk_index = get_disk_index()
+    if disk_id.lower() not in disk_index:
+        # Disks created after the index was built fall back to their own lookup
+        disk_index[disk_id.lower()] = get_clients().compute_client.disks.get(disk_id.split("/")[4], disk_id.split("/")[-1])
+    return disk_index[disk_id.lower()]
+
 def is_vm_deallocated(vm):
     """Check if a VM is deallocated."""
-    resource_group_name = vm.id.split("/")[4]
-    vm_instance_view = compute_client.virtual_machines.instance_view(resource_group_name, vm.name)
-    statuses = vm_instance_view.statuses
-    return any(status.code == 'PowerState/deallocated' for status in statuses)
+    return get_power_state(vm) == 'PowerState/deallocated'
 
 def downgrade_disks_of_vm(vm, status_log, dry_run=True, subscription_id=None):
     """Downgrade the disks of a VM to Standard_LRS."""
     try:
-        resource_group_name = vm.id.split("/")[4]
-        vm_instance = compute_client.virtual_machines.get(resource_group_name, vm.name, expand='instanceView')
-
-        # Process the OS disk
-        os_disk = vm_instance.storage_profile.os_disk
-        if os_disk.managed_disk:
-            os_disk_id = os_disk.managed_disk.id
-            os_disk_name = os_disk_id.split('/')[-1]
-            os_disk_rg = os_disk_id.split('/')[4]
-            logger.info(f"Processing OS disk {os_disk_name} with ID {os_disk_id} in RG {os_disk_rg}")
+        storage_profile = vm.storage_profile
+        if storage_profile is None:
+            resource_group_name = vm.id.split("/")[4]
+            storage_profile = get_clients().compute_client.virtual_machines.get(resource_group_name, vm.name).storage_profile
+
+        # Pick the managed disks that are not Standard_LRS yet from the disk index
+        candidates = []
+        for disk_kind, disk in [("OS", storage_profile.os_disk)] + [("data", disk) for disk in storage_profile.data_disks or []]:
+            if not disk.managed_disk:
+                continue
+            disk_id = disk.managed_disk.id
+            disk_name = disk_id.split('/')[-1]
+            logger.info(f"Processing {disk_kind} disk {disk_name} with ID {disk_id}")
             try:
-                managed_disk = compute_client.disks.get(os_disk_rg, os_disk_name)
-                if dry_run:
-                    log_entry = {
-                        "SubscriptionId": subscription_id,
-                        "Resource": managed_disk.name,
-                        "Action": "downgrade_disks",
-                        "Status": "Dry Run",
-                        "Message": f"Would downgrade OS disk {managed_disk.name} to Standard_LRS"
-                    }
-                    status_log.append(log_entry)
-                else:
-                    status, message = downgrade_disk(managed_disk)
-                    log_entry = {
-                        "SubscriptionId": subscription_id,
-                        "Resource": managed_disk.name,
-                        "Action": "downgrade_disks",
-                        "Status": status,
-                        "Message": message,
-                    }
-                    status_log.append(log_entry)
+                managed_disk = get_managed_disk(disk_id)
             except Exception as e:
-                log_entry = {
+                status_log.append({
                     "SubscriptionId": subscription_id,
-                    "Resource": os_disk_name,
+                    "Resource": disk_name,
                     "Action": "downgrade_disks",
                     "Status": "Failed",
-                    "Message": f"Failed to downgrade OS disk {os_disk_name} for VM {vm.name}: {e}"
-                }
-                status_log.append(log_entry)
-                logger.error(f"Failed to downgrade OS disk {os_disk_name} for VM {vm.name}: {e}")
-
-        # Process the data disks
-        for disk in vm_instance.storage_profile.data_disks:
-            if disk.managed_disk:
-                data_disk_id = disk.managed_disk.id
-                data_disk_name = data_disk_id.split('/')[-1]
-                data_disk_rg = data_disk_id.split('/')[4]
-                logger.info(f"Processing data disk {data_disk_name} with ID {data_disk_id} in RG {data_disk_rg}")
-                try:
-                    managed_disk = compute_client.disks.get(data_disk_rg, data_disk_name)
-                    if dry_run:
-                        log_entry = {
-                            "SubscriptionId": subscription_id,
-                            "Resource": managed_disk.name,
-                            "Action": "downgrade_disks",
-                            "Status": "Dry Run",
-                            "Message": f"Would downgrade data disk {managed_disk.name} to Standard_LRS"
-                        }
-                        status_log.append(log_entry)
-                    else:
-                        status, message = downgrade_disk(managed_disk)
-                        log_entry = {
-                            "SubscriptionId": subscription_id,
-                            "Resource": managed_disk.name,
-                            "Action": "downgrade_disks",
-                            "Status": status,
-                            "Message": message,
-                        }
-                        status_log.append(log_entry)
-                except Exception as e:
-                    log_entry = {
+                    "Message": f"Failed to downgrade {disk_kind} disk {disk_name} for VM {vm.name}: {e}"
+                })
+                logger.error(f"Failed to downgrade {disk_kind} disk {disk_name} for VM {vm.name}: {e}")
+                continue
+            if managed_disk.sku and managed_disk.sku.name == StorageAccountTypes.standard_lrs:
+                status_log.append({
+                    "SubscriptionId": subscription_id,
+                    "Resource": managed_disk.name,
+                    "Action": "downgrade_disks",
+                    "Status": "No Action",
+                    "Message": f"{disk_kind} disk {managed_disk.name} is already Standard_LRS"
+                })
+                continue
+            candidates.append((disk_kind, managed_disk))
+
+        if dry_run:
+            for disk_kind, managed_disk in candidates:
+                status_log.append({
+                    "SubscriptionId": subscription_id,
+                    "Resource": managed_disk.name,
+                    "Action": "downgrade_disks",
+                    "Status": "Dry Run",
+                    "Message": f"Would downgrade {disk_kind} disk {managed_disk.name} to Standard_LRS"
+                })
+        elif candidates:
+            # The SKU changes of the disks of a VM are independent, so they run in parallel up to the per-type action cap.
+            # The VM already holds an action slot, taking more per disk could deadlock a subscription with a single slot.
+            with ThreadPoolExecutor(max_workers=min(len(candidates), get_run_context().max_parallel_actions_per_type)) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, downgrade_disk, managed_disk) for _, managed_disk in candidates]
+                for (disk_kind, managed_disk), future in zip(candidates, futures):
+                    status, message = future.result()
+                    status_log.append({
                         "SubscriptionId": subscription_id,
-                        "Resource": data_disk_name,
+                        "Resource": managed_disk.name,
                         "Action": "downgrade_disks",
-                        "Status": "Failed",
-                        "Message": f"Failed to downgrade data disk {data_disk_name} for VM {vm.name}: {e}"
-                    }
-                    status_log.append(log_entry)
-                    logger.error(f"Failed to downgrade data disk {data_disk_name} for VM {vm.name}: {e}")
+                        "Status": status,
+                        "Message": message,
+                    })
         return "Success", "Disk downgrades processed."
     except Exception as e:
         log_entry = {
@@ -773,7 +1829,7 @@ def delete_disk(disk):
     try:
         logger.info(f"Attempting to delete disk: {disk.name}")
         resource_group_name = disk.id.split("/")[4]
-        async_delete = compute_client.disks.begin_delete(resource_group_name, disk.name)
+        async_delete = get_clients().compute_client.disks.begin_delete(resource_group_name, disk.name)
         async_delete.result()
         tc.track_event("DiskDeleted", {"DiskName": disk.name})
         return "Success", "Disk deleted successfully."
@@ -786,10 +1842,16 @@ def delete_resource_group(resource_group):
     """Delete all resources in a resource group."""
     try:
         logger.info(f"Deleting Resource Group: {resource_group.name}")
-        delete_operation = resource_client.resource_groups.begin_delete(resource_group.name)
-        while not delete_operation.done():
-            print("Deleting resource group, please wait...")
-            time.sleep(10)
+        if get_run_context().operations_store:
+            if has_pending_operation(resource_group.id, "delete_resource_group"):
+                return "Pending", "Resource group deletion already in progress."
+            get_clients().resource_client.resource_groups.begin_delete(resource_group.name)
+            record_pending_operation(resource_group.id, resource_group.name, "delete_resource_group")
+            return "Pending", "Resource group deletion submitted."
+        delete_operation = get_clients().resource_client.resource_groups.begin_delete(resource_group.name)
+        logger.info(f"Waiting for the deletion of Resource Group {resource_group.name}")
+        # The poller waits on the service's polling interval and raises if the deletion fails
+        delete_operation.result()
         operation_status = delete_operation.status()
         if operation_status == "Succeeded":
             tc.track_event("ResourceGroupDeleted", {"ResourceGroupName": resource_group.name})
@@ -821,7 +1883,7 @@ def delete_public_ip(public_ip):
     try:
         logger.info(f"Deleting Public IP: {public_ip.name}")
         resource_group_name = public_ip.id.split("/")[4]
-        async_delete = network_client.public_ip_addresses.begin_delete(resource_group_name, public_ip.name)
+        async_delete = get_clients().network_client.public_ip_addresses.begin_delete(resource_group_name, public_ip.name)
         async_delete.result()
         tc.track_event("PublicIPDeleted", {"PublicIPName": public_ip.name})
         return "Success", "Public IP deleted successfully."
@@ -881,11 +1943,12 @@ def update_storage_account_sku(storage_account, new_sku):
     """Update the SKU of a storage account"""
     try:
         logger.info(f"Updating storage account SKU: {storage_account.name}")
-        storage_client.storage_accounts.update(
+        updated_account = get_clients().storage_client.storage_accounts.update(
             resource_group_name=storage_account.id.split("/")[4],
             account_name=storage_account.name,
             parameters={"sku": {"name": new_sku}},
         )
+        storage_account.sku = updated_account.sku
         tc.track_event("StorageAccountSkuUpdated", {"StorageAccountName": storage_account.name, "NewSku": new_sku})
         return "Success", f"Storage account SKU updated to {new_sku}."
     except Exception as e:
@@ -930,6 +1993,12 @@ def simple_scale_sql_database(sql_client, database, new_dtu, min_dtu, max_dtu, d
         if dry_run:
             logger.info("This is a dry run. No changes will be made.")
             return "Dry Run", f"Would scale DTU to {new_dtu}."
+        elif get_run_context().operations_store:
+            if has_pending_operation(database.id, "scale_sql_database"):
+                return "Pending", "A DTU change is already in progress."
+            sql_client.databases.begin_create_or_update(resource_group_name, server_name, database_name, update_parameters)
+            record_pending_operation(database.id, database.name, "scale_sql_database", str(new_dtu))
+            return "Pending", f"Scaling DTU to {new_dtu} submitted."
         else:
             sql_client.databases.begin_create_or_update(resource_group_name, server_name, database_name, update_parameters).result()
             while True:
@@ -945,57 +2014,323 @@ def simple_scale_sql_database(sql_client, database, new_dtu, min_dtu, max_dtu, d
         logger.error(f"Error scaling SQL database {database.name}: {str(e)}")
         return "Error", str(e)
 
-def scale_sql_database(database, tiers, status_log, dry_run=True, subscription_id=None):
-    """Scale SQL database based on tier and time of day."""
-    current_time = datetime.now().time()
+def get_sql_target_dtu(database, tiers, current_time):
+    """Return the tier matching a database and the DTU it should run at the given time, or (None, None)."""
     for tier in tiers:
         if tier["name"] in database.sku.name:
             off_peak_start = tier.get("off_peak_start")
             off_peak_end = tier.get("off_peak_end")
 
             if off_peak_start is None or off_peak_end is None:
-                new_dtu = tier["off_peak_dtu"]
+                return tier, tier["off_peak_dtu"]
+
+            off_peak_start = datetime.strptime(off_peak_start, "%H:%M").time()
+            off_peak_end = datetime.strptime(off_peak_end, "%H:%M").time()
+
+            if off_peak_start < off_peak_end:
+                is_off_peak = off_peak_start <= current_time < off_peak_end
             else:
-                off_peak_start = datetime.strptime(off_peak_start, "%H:%M").time()
-                off_peak_end = datetime.strptime(off_peak_end, "%H:%M").time()
+                is_off_peak = not (off_peak_end <= current_time < off_peak_start)
 
-                if off_peak_start < off_peak_end:
-                    is_off_peak = off_peak_start <= current_time < off_peak_end
-                else:
-                    is_off_peak = not (off_peak_end <= current_time < off_peak_start)
+            return tier, tier["off_peak_dtu"] if is_off_peak else tier["peak_dtu"]
+    return None, None
 
-                new_dtu = tier["off_peak_dtu"] if is_off_peak else tier["peak_dtu"]
+def scale_sql_database(database, tiers, status_log, dry_run=True, subscription_id=None, current_time=None):
+    """Scale SQL database based on tier and time of day."""
+    tier, new_dtu = get_sql_target_dtu(database, tiers, current_time or datetime.now().time())
+    if tier is None:
+        return "No Change", "Current DTU is already optimal."
 
-            if new_dtu == database.sku.capacity:
-                message = "Current DTU is already optimal. No scaling required."
-                logger.info(f"Database: {database.name}, {message}")
-                status_log.append(
+    if new_dtu == database.sku.capacity:
+        message = "Current DTU is already optimal. No scaling required."
+        logger.info(f"Database: {database.name}, {message}")
+        status_log.append(
+            {
+                "SubscriptionId": subscription_id,
+                "Resource": database.name,
+                "Action": "scale",
+                "Status": "No Change",
+                "Message": message,
+            }
+        )
+        return "No Change", message
+
+    logger.info(f"Database: {database.name}, Current DTU: {database.sku.capacity}, New DTU: {new_dtu}")
+    if dry_run:
+        status, message = "Dry Run", f"Dry run mode, no action taken. Would scale DTU to {new_dtu}"
+    else:
+        status, message = simple_scale_sql_database(get_clients().sql_client, database, new_dtu, tier["min_dtu"], tier["max_dtu"], dry_run)
+    logger.info(f"Scale status for {database.name}: {message}")
+    status_log.append(
+        {
+            "SubscriptionId": subscription_id,
+            "Resource": database.name,
+            "Action": "scale",
+            "Status": status,
+            "Message": message,
+        }
+    )
+    return "Success" if dry_run else status, message
+
+def get_sql_server_id(database):
+    """Return the lower-cased id of the logical server of a database."""
+    return "/".join(database.id.lower().split("/")[:9])
+
+def scale_sql_fleet(databases, tiers, status_log, dry_run=True, subscription_id=None):
+    """Scale SQL databases to their target DTU concurrently, capping the rescales in flight per logical server."""
+    context = get_run_context()
+    # One point in time for the whole fleet, so databases cannot straddle the peak boundary
+    current_time = datetime.now().time()
+    results = {}
+    databases_by_server = defaultdict(list)
+    for database in databases:
+        tier, new_dtu = get_sql_target_dtu(database, tiers, current_time)
+        if tier is None or new_dtu == database.sku.capacity:
+            results[database.id] = scale_sql_database(database, tiers, status_log, dry_run, subscription_id, current_time)
+        else:
+            databases_by_server[get_sql_server_id(database)].append(database)
+    if not databases_by_server:
+        return [(database, *results[database.id]) for database in databases]
+
+    # Interleave the servers so the workers are spread over them instead of queueing on one server's cap
+    server_slots = {server_id: threading.BoundedSemaphore(context.max_parallel_sql_scales_per_server) for server_id in databases_by_server}
+    queue = [database for group in zip_longest(*databases_by_server.values()) for database in group if database is not None]
+
+    def scale(database):
+        with server_slots[get_sql_server_id(database)]:
+            return scale_sql_database(database, tiers, status_log, dry_run, subscription_id, current_time)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=context.max_parallel_sql_scales) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, scale, database) for database in queue]
+        for database, future in zip(queue, futures):
+            try:
+                results[database.id] = future.result()
+            except Exception as e:
+                logger.error(f"Error scaling SQL database {database.name}: {e}")
+                results[database.id] = ("Error", str(e))
+    converged = time.monotonic()
+    if dry_run or context.operations_store:
+        # Nothing has converged: a dry run changes nothing and with an operations store the rescales are only submitted
+        logger.info(f"{'Planned' if dry_run else 'Submitted'} rescales of {len(queue)} SQL databases on {len(databases_by_server)} servers for subscription {subscription_id} in {converged - started:.2f} seconds")
+        return [(database, *results[database.id]) for database in databases]
+    with context.sql_fleet.lock:
+        context.sql_fleet.started = min(context.sql_fleet.started or started, started)
+        context.sql_fleet.converged = max(context.sql_fleet.converged or converged, converged)
+        context.sql_fleet.databases += len(queue)
+    logger.info(f"Rescaled {len(queue)} SQL databases on {len(databases_by_server)} servers for subscription {subscription_id} in {converged - started:.2f} seconds")
+    tc.track_metric("SqlScaleTimeToConverge", converged - started, properties={"SubscriptionId": subscription_id, "Databases": len(queue), "Servers": len(databases_by_server)})
+    return [(database, *results[database.id]) for database in databases]
+
+def open_operations_store(store_file):
+    """Open the durable operations store, creating its table on first use."""
+    os.makedirs(os.path.dirname(store_file) or ".", exist_ok=True)
+    connection = sqlite3.connect(store_file, timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS operations (
+            operation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            subscription_id TEXT NOT NULL,
+            resource_id TEXT NOT NULL,
+            resource_name TEXT NOT NULL,
+            operation TEXT NOT NULL,
+            target TEXT,
+            status TEXT NOT NULL,
+            started_at TEXT NOT NULL,
+            resolved_at TEXT,
+            message TEXT
+        );
+        CREATE INDEX IF NOT EXISTS operations_by_status ON operations (status, subscription_id);
+        """
+    )
+    return connection
+
+def record_pending_operation(resource_id, resource_name, operation, target=None):
+    """Record a submitted long-running operation as pending in the operations store."""
+    with closing(open_operations_store(get_run_context().operations_store)) as connection, connection:
+        connection.execute(
+            "INSERT INTO operations (subscription_id, resource_id, resource_name, operation, target, status, started_at) VALUES (?, ?, ?, ?, ?, 'Pending', ?)",
+            (get_clients().subscription_id, resource_id.lower(), resource_name, operation, target, datetime.now(timezone.utc).isoformat()),
+        )
+    tc.track_event("OperationSubmitted", {"Operation": operation, "ResourceName": resource_name})
+
+def has_pending_operation(resource_id, operation):
+    """Check if an operation on a resource is already pending in the operations store."""
+    with closing(open_operations_store(get_run_context().operations_store)) as connection:
+        row = connection.execute(
+            "SELECT 1 FROM operations WHERE resource_id = ? AND operation = ? AND status = 'Pending'",
+            (resource_id.lower(), operation),
+        ).fetchone()
+    return row is not None
+
+def resolve_resource_group_deletion(operation, resource_groups):
+    """Return the (status, message) of a pending resource group deletion given the current resource groups."""
+    resource_group = resource_groups.get(operation["resource_name"].lower())
+    if resource_group is None:
+        return "Succeeded", "Resource group deleted successfully."
+    if resource_group.properties and resource_group.properties.provisioning_state == "Deleting":
+        return "Pending", "Resource group deletion in progress."
+    return "Failed", "Failed to delete resource group: Deletion operation did not succeed"
+
+def resolve_sql_rescale(operation, databases):
+    """Return the (status, message) of a pending DTU change given the current databases of its server."""
+    database = databases.get(operation["resource_id"])
+    if database is None:
+        return "Failed", "Database no longer exists."
+    if database.sku.capacity == int(operation["target"]):
+        return "Succeeded", f"Scaled DTU to {operation['target']}."
+    return "Pending", f"Scaling DTU to {operation['target']} in progress."
+
+def reconcile_subscription_operations(subscription_id, operations):
+    """Resolve the pending operations of one subscription with one listing per resource kind and SQL server."""
+    client_context.set(create_subscription_clients(subscription_id))
+    clients = get_clients()
+    resolutions = []
+
+    deletions = [operation for operation in operations if operation["operation"] == "delete_resource_group"]
+    if deletions:
+        resource_groups = {resource_group.name.lower(): resource_group for resource_group in clients.resource_client.resource_groups.list()}
+        resolutions.extend((operation, *resolve_resource_group_deletion(operation, resource_groups)) for operation in deletions)
+
+    rescales_by_server = defaultdict(list)
+    for operation in operations:
+        if operation["operation"] == "scale_sql_database":
+            rescales_by_server[get_parent_resource_id(operation["resource_id"])].append(operation)
+    for server_id, rescales in rescales_by_server.items():
+        databases = {
+            database.id.lower(): database
+            for database in clients.sql_client.databases.list_by_server(server_id.split("/")[4], server_id.split("/")[8])
+        }
+        resolutions.extend((operation, *resolve_sql_rescale(operation, databases)) for operation in rescales)
+    return resolutions
+
+def reconcile_operations():
+    """Resolve the pending operations of the operations store in bulk and return the ones that completed."""
+    store_file = get_run_context().operations_store
+    with closing(open_operations_store(store_file)) as connection:
+        pending = [dict(row) for row in connection.execute("SELECT * FROM operations WHERE status = 'Pending' ORDER BY operation_id")]
+    if not pending:
+        return []
+    operations_by_subscription = defaultdict(list)
+    for operation in pending:
+        operations_by_subscription[operation["subscription_id"]].append(operation)
+
+    now = datetime.now(timezone.utc)
+    reconciled = []
+    with closing(open_operations_store(store_file)) as connection, connection:
+        for subscription_id, operations in operations_by_subscription.items():
+            try:
+                # Each subscription gets a copy of the current context so its clients stay private to it
+                resolutions = contextvars.copy_context().run(reconcile_subscription_operations, subscription_id, operations)
+            except Exception as e:
+                logger.error(f"Failed to reconcile operations of subscription {subscription_id}: {e}")
+                continue
+            for operation, status, message in resolutions:
+                if status == "Pending" and now - datetime.fromisoformat(operation["started_at"]) > OPERATION_TIMEOUT:
+                    status, message = "Failed", f"Operation did not complete within {OPERATION_TIMEOUT}."
+                if status == "Pending":
+                    continue
+                connection.execute(
+                    "UPDATE operations SET status = ?, resolved_at = ?, message = ? WHERE operation_id = ?",
+                    (status, now.isoformat(), message, operation["operation_id"]),
+                )
+                tc.track_event(f"Operation{status}", {"Operation": operation["operation"], "ResourceName": operation["resource_name"], "Message": message})
+                reconciled.append(
                     {
                         "SubscriptionId": subscription_id,
-                        "Resource": database.name,
-                        "Action": "scale",
-                        "Status": "No Change",
+                        "Resource": operation["resource_name"],
+                        "Operation": operation["operation"],
+                        "Status": status,
                         "Message": message,
                     }
                 )
-                return "No Change", message
-
-            logger.info(f"Database: {database.name}, Current DTU: {database.sku.capacity}, New DTU: {new_dtu}")
-            message = f"Dry run mode, no action taken. Would scale DTU to {new_dtu}" if dry_run else f"Scaled DTU to {new_dtu}"
-            logger.info(f"Scale status for {database.name}: {message}")
-            status_log.append(
-                {
-                    "SubscriptionId": subscription_id,
-                    "Resource": database.name,
-                    "Action": "scale",
-                    "Status": "Dry Run" if dry_run else "Success",
-                    "Message": message,
+    logger.info(f"Reconciled {len(reconciled)} of {len(pending)} pending operation(s)")
+    return reconciled
+
+def open_state_store(store_file):
+    """Open the desired-state store, creating its table on first use."""
+    os.makedirs(os.path.dirname(store_file) or ".", exist_ok=True)
+    connection = sqlite3.connect(store_file, timeout=30)
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS desired_state (
+            resource_id TEXT NOT NULL,
+            action TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            recorded_at TEXT NOT NULL,
+            PRIMARY KEY (resource_id, action)
+        )
+        """
+    )
+    return connection
+
+def get_resource_fingerprint(resource):
+    """Return the ETag of a resource, or a hash of the fields the policies read for resource types without one."""
+    etag = getattr(resource, "etag", None)
+    if not etag:
+        # Server-maintained fields such as provisioning_state or last_modified_time differ between listings and are left out
+        properties = resource.as_dict()
+        etag = hashlib.sha256(json.dumps({field: properties.get(field) for field in FINGERPRINT_FIELDS}, sort_keys=True, default=str).encode()).hexdigest()
+    fingerprint = etag
+    if resource.id.lower().split("/providers/")[-1].startswith("microsoft.compute/virtualmachines/"):
+        # Starting or deallocating a VM changes neither its ETag nor its model, the power-state index does
+        fingerprint += f"|{get_power_state(resource)}"
+    return fingerprint
+
+def get_desired_state():
+    """Return the recorded fingerprints of the current subscription indexed by (lower-cased resource id, action), loaded once on first use."""
+    clients = get_clients()
+    with clients.inventory_lock:
+        type_lock = clients.inventory_type_locks.setdefault("desired_state", threading.Lock())
+    with type_lock:
+        if clients.desired_state is None:
+            with closing(open_state_store(get_run_context().state_store)) as connection:
+                clients.desired_state = {
+                    (resource_id, action): fingerprint
+                    for resource_id, action, fingerprint in connection.execute(
+                        "SELECT resource_id, action, fingerprint FROM desired_state WHERE resource_id LIKE ?",
+                        (f"/subscriptions/{clients.subscription_id.lower()}/%",),
+                    )
                 }
-            )
-            if not dry_run:
-                simple_scale_sql_database(sql_client, database, new_dtu, tier["min_dtu"], tier["max_dtu"], dry_run)
-            return "Success", message
-    return "No Change", "Current DTU is already optimal."
+        return clients.desired_state
+
+def skip_converged_resources(resources, actions):
+    """Drop the resources whose actions all succeeded before and that did not change since."""
+    if not get_run_context().state_store:
+        return resources
+    desired_state = get_desired_state()
+    pending = []
+    for resource in resources:
+        keys = [(resource.id.lower(), action["type"]) for action in actions]
+        if not all(key in desired_state for key in keys):
+            pending.append(resource)
+            continue
+        fingerprint = get_resource_fingerprint(resource)
+        if any(desired_state[key] != fingerprint for key in keys):
+            pending.append(resource)
+    if len(pending) < len(resources):
+        logger.info(f"Skipped {len(resources) - len(pending)} resource(s) already converged for {', '.join(action['type'] for action in actions)}")
+    return pending
+
+def record_desired_state(resource, actions, action_log):
+    """Record the fingerprint of a resource once all of its actions succeeded or found nothing to do."""
+    if not action_log or any(entry["Status"] not in ("Success", "No Action", "No Change") for entry in action_log):
+        return
+    # Deleted resources are not evaluated again
+    action_types = [action["type"] for action in actions if action["type"] != "delete"]
+    if not action_types:
+        return
+    fingerprint = get_resource_fingerprint(resource)
+    recorded_at = datetime.now(timezone.utc).isoformat()
+    with closing(open_state_store(get_run_context().state_store)) as connection, connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO desired_state (resource_id, action, fingerprint, recorded_at) VALUES (?, ?, ?, ?)",
+            [(resource.id.lower(), action_type, fingerprint, recorded_at) for action_type in action_types],
+        )
+    desired_state = get_desired_state()
+    for action_type in action_types:
+        desired_state[(resource.id.lower(), action_type)] = fingerprint
 
 def wrap_text(text, width=30):
     """Wrap text to a given width."""
@@ -1007,7 +2342,8 @@ def review_application_gateways(policies, status_log, dry_run=True):
     for policy in policies:
         if policy["resource"] == "azure.applicationgateway":
             logger.info(f"Reviewing application gateways for policy: {policy['name']}")
-            gateways = network_client.application_gateways.list_all()
+            network_client = get_clients().network_client
+            gateways = list_resources("azure.applicationgateway")
             for gateway in gateways:
                 if not gateway.backend_address_pools or any(not pool.backend_addresses for pool in gateway.backend_address_pools):
                     if evaluate_filters(gateway, policy["filters"]):
@@ -1018,6 +2354,7 @@ def review_application_gateways(policies, status_log, dry_run=True):
                                     {
                                         "Policy": policy["name"],
                                         "Resource": gateway.name,
+                                        "ResourceId": gateway.id,
                                         "Actions": ", ".join([action["type"] for action in policy["actions"]]),
                                         "Status": status,
                                         "Message": message,
@@ -1059,231 +2396,585 @@ def evaluate_unattached_filter(disk):
     logger.info(f"Disk {disk.name} is attached.")
     return False
 
-def apply_policies(policies, dry_run, subscription_id, impacted_resources, non_impacted_resources, status_log):
-    """Apply policies to resources."""
-    for policy in policies:
-        resource_type = policy["resource"]
-        filters = policy["filters"]
-        actions = policy["actions"]
-        exclusions = policy.get("exclusions", [])
-
-        resources_impacted = False
+def apply_policies(policies, dry_run, subscription_id, impacted_resources, non_impacted_resources, status_log, max_parallel_policies=1, policy_timings=None):
+    """Apply policies to resources, evaluating up to max_parallel_policies policies concurrently."""
+    def run_policy(policy):
+        result = {
+            "impacted_resources": [],
+            "non_impacted_resources": [],
+            "status_log": [],
+        }
+        policy_start = time.perf_counter()
+        try:
+            apply_policy(policy, dry_run, subscription_id, result["impacted_resources"], result["non_impacted_resources"], result["status_log"])
+        except Exception as e:
+            # A failing policy must not discard the results of the other policies of the subscription
+            logger.error(f"Error in policy {policy['name']} for subscription {subscription_id}: {e}")
+            tc.track_exception(properties={"SubscriptionId": subscription_id, "Policy": policy["name"]})
+            result.update(impacted_resources=[], non_impacted_resources=[], status_log=[])
+        result["duration"] = time.perf_counter() - policy_start
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel_policies)) as executor:
+        # Policies share no state, each one only needs the subscription clients of this context
+        futures = [executor.submit(contextvars.copy_context().run, run_policy, policy) for policy in policies]
+        results = [future.result() for future in futures]
+
+    for policy, result in zip(policies, results):
+        impacted_resources.extend(result["impacted_resources"])
+        non_impacted_resources.extend(result["non_impacted_resources"])
+        status_log.extend(result["status_log"])
+        logger.info(f"Policy {policy['name']} completed in {result['duration']:.2f} seconds for subscription {subscription_id}")
+        tc.track_metric("PolicyDuration", result["duration"], properties={"SubscriptionId": subscription_id, "Policy": policy["name"]})
+        if policy_timings is not None:
+            policy_timings.append(
+                {
+                    "SubscriptionId": subscription_id,
+                    "Policy": policy["name"],
+                    "ResourceType": policy["resource"],
+                    "Duration": result["duration"],
+                }
+            )
 
-        if resource_type == "azure.vm":
-            vms = compute_client.virtual_machines.list_all()
-            for vm in vms:
-                logger.info(f"Evaluating VM {vm.name}")
-                if not evaluate_exclusions(vm, exclusions) and evaluate_filters(vm, filters):
-                    owner = get_owner_tag(vm)
-                    logger.info(f"VM {vm.name} meets filters and exclusions")
-                    apply_actions(vm, actions, status_log, dry_run, subscription_id)
-                    impacted_resources.append(
-                        {
-                            "SubscriptionId": subscription_id,
-                            "Policy": policy["name"],
-                            "Resource": vm.name,
-                            "Actions": ", ".join([action["type"] for action in actions]),
-                            "Owner": owner,
-                        }
-                    )
-                    resources_impacted = True
-            if not resources_impacted:
-                non_impacted_resources.append(
+def apply_policy(policy, dry_run, subscription_id, impacted_resources, non_impacted_resources, status_log):
+    """Apply a single policy to resources."""
+    resource_type = policy["resource"]
+    filters = policy["filters"]
+    actions = policy["actions"]
+    exclusions = policy.get("exclusions", [])
+
+    resources_impacted = False
+    action_futures = []
+
+    if resource_type == "azure.vm":
+        vms = skip_converged_resources(list_resources("azure.vm"), actions)
+        # Collect the CPU usage of every candidate VM in batches before the filters are evaluated one VM at a time
+        candidates = [vm for vm in vms if not evaluate_exclusions(vm, exclusions)]
+        for filter in filters:
+            if filter["type"] == "last_used":
+                prefetch_cpu_usage(candidates, filter["days"])
+        for vm in vms:
+            logger.info(f"Evaluating VM {vm.name}")
+            if not evaluate_exclusions(vm, exclusions) and evaluate_filters(vm, filters):
+                owner = get_owner_tag(vm)
+                logger.info(f"VM {vm.name} meets filters and exclusions")
+                action_futures.append(submit_actions(vm, actions, status_log, dry_run, subscription_id, resource_type, policy))
+                impacted_resources.append(
                     {
                         "SubscriptionId": subscription_id,
                         "Policy": policy["name"],
-                        "ResourceType": "VM",
+                        "Resource": vm.name,
+                        "ResourceId": vm.id,
+                        "Actions": ", ".join([action["type"] for action in actions]),
+                        "Owner": owner,
                     }
                 )
+                resources_impacted = True
+        if not resources_impacted:
+            non_impacted_resources.append(
+                {
+                    "SubscriptionId": subscription_id,
+                    "Policy": policy["name"],
+                    "ResourceType": "VM",
+                }
+            )
 
-        elif resource_type == "azure.disk":
-            disks = compute_client.disks.list()
-            for disk in disks:
-                logger.info(f"Evaluating disk {disk.name}")
-                if not evaluate_exclusions(disk, exclusions) and evaluate_filters(disk, filters):
-                    owner = get_owner_tag(disk)
-                    apply_actions(disk, actions, status_log, dry_run, subscription_id)
-                    impacted_resources.append(
-                        {
-                            "SubscriptionId": subscription_id,
-                            "Policy": policy["name"],
-                            "Resource": disk.name,
-                            "Actions": ", ".join([action["type"] for action in actions]),
-                            "Owner": owner,
-                        }
-                    )
-                    resources_impacted = True
-            if not resources_impacted:
-                non_impacted_resources.append(
+    elif resource_type == "azure.disk":
+        disks = skip_converged_resources(list_resources("azure.disk"), actions)
+        for disk in disks:
+            logger.info(f"Evaluating disk {disk.name}")
+            if not evaluate_exclusions(disk, exclusions) and evaluate_filters(disk, filters):
+                owner = get_owner_tag(disk)
+                action_futures.append(submit_actions(disk, actions, status_log, dry_run, subscription_id, resource_type, policy))
+                impacted_resources.append(
                     {
                         "SubscriptionId": subscription_id,
                         "Policy": policy["name"],
-                        "ResourceType": "Disk",
+                        "Resource": disk.name,
+                        "ResourceId": disk.id,
+                        "Actions": ", ".join([action["type"] for action in actions]),
+                        "Owner": owner,
                     }
                 )
+                resources_impacted = True
+        if not resources_impacted:
+            non_impacted_resources.append(
+                {
+                    "SubscriptionId": subscription_id,
+                    "Policy": policy["name"],
+                    "ResourceType": "Disk",
+                }
+            )
 
-        elif resource_type == "azure.resourcegroup":
-            resource_groups = resource_client.resource_groups.list()
-            for resource_group in resource_groups:
-                if not evaluate_exclusions(resource_group, exclusions) and evaluate_filters(resource_group, filters):
-                    owner = get_owner_tag(resource_group)
-                    apply_actions(resource_group, actions, status_log, dry_run, subscription_id)
-                    impacted_resources.append(
-                        {
-                            "SubscriptionId": subscription_id,
-                            "Policy": policy["name"],
-                            "Resource": resource_group.name,
-                            "Actions": ", ".join([action["type"] for action in actions]),
-                            "Owner": owner,
-                        }
-                    )
-                    resources_impacted = True
-            if not resources_impacted:
-                non_impacted_resources.append(
+    elif resource_type == "azure.resourcegroup":
+        resource_groups = skip_converged_resources(list_resources("azure.resourcegroup"), actions)
+        for resource_group in resource_groups:
+            if not evaluate_exclusions(resource_group, exclusions) and evaluate_filters(resource_group, filters):
+                owner = get_owner_tag(resource_group)
+                action_futures.append(submit_actions(resource_group, actions, status_log, dry_run, subscription_id, resource_type, policy))
+                impacted_resources.append(
                     {
                         "SubscriptionId": subscription_id,
                         "Policy": policy["name"],
-                        "ResourceType": "Resource Group",
+                        "Resource": resource_group.name,
+                        "ResourceId": resource_group.id,
+                        "Actions": ", ".join([action["type"] for action in actions]),
+                        "Owner": owner,
                     }
                 )
+                resources_impacted = True
+        if not resources_impacted:
+            non_impacted_resources.append(
+                {
+                    "SubscriptionId": subscription_id,
+                    "Policy": policy["name"],
+                    "ResourceType": "Resource Group",
+                }
+            )
 
-        elif resource_type == "azure.storage":
-            storage_accounts = storage_client.storage_accounts.list()
-            for storage_account in storage_accounts:
-                if not evaluate_exclusions(storage_account, exclusions) and evaluate_filters(storage_account, filters):
-                    owner = get_owner_tag(storage_account)
-                    apply_actions(storage_account, actions, status_log, dry_run, subscription_id)
-                    impacted_resources.append(
-                        {
-                            "SubscriptionId": subscription_id,
-                            "Policy": policy["name"],
-                            "Resource": storage_account.name,
-                            "Actions": ", ".join([action["type"] for action in actions]),
-                            "Owner": owner,
-                        }
-                    )
-                    resources_impacted = True
-            if not resources_impacted:
-                non_impacted_resources.append(
+    elif resource_type == "azure.storage":
+        storage_accounts = skip_converged_resources(list_resources("azure.storage"), actions)
+        for storage_account in storage_accounts:
+            if not evaluate_exclusions(storage_account, exclusions) and evaluate_filters(storage_account, filters):
+                owner = get_owner_tag(storage_account)
+                action_futures.append(submit_actions(storage_account, actions, status_log, dry_run, subscription_id, resource_type, policy))
+                impacted_resources.append(
                     {
                         "SubscriptionId": subscription_id,
                         "Policy": policy["name"],
-                        "ResourceType": "Storage Account",
+                        "Resource": storage_account.name,
+                        "ResourceId": storage_account.id,
+                        "Actions": ", ".join([action["type"] for action in actions]),
+                        "Owner": owner,
                     }
                 )
+                resources_impacted = True
+        if not resources_impacted:
+            non_impacted_resources.append(
+                {
+                    "SubscriptionId": subscription_id,
+                    "Policy": policy["name"],
+                    "ResourceType": "Storage Account",
+                }
+            )
 
-        elif resource_type == "azure.publicip":
-            public_ips = network_client.public_ip_addresses.list_all()
-            for public_ip in public_ips:
-                if not evaluate_exclusions(public_ip, exclusions) and evaluate_filters(public_ip, filters):
-                    owner = get_owner_tag(public_ip)
-                    apply_actions(public_ip, actions, status_log, dry_run, subscription_id)
-                    impacted_resources.append(
-                        {
-                            "SubscriptionId": subscription_id,
-                            "Policy": policy["name"],
-                            "Resource": public_ip.name,
-                            "Actions": ", ".join([action["type"] for action in actions]),
-                            "Owner": owner,
-                        }
-                    )
-                    resources_impacted = True
-
-            if not resources_impacted:
-                non_impacted_resources.append(
+    elif resource_type == "azure.publicip":
+        public_ips = skip_converged_resources(list_resources("azure.publicip"), actions)
+        for public_ip in public_ips:
+            if not evaluate_exclusions(public_ip, exclusions) and evaluate_filters(public_ip, filters):
+                owner = get_owner_tag(public_ip)
+                action_futures.append(submit_actions(public_ip, actions, status_log, dry_run, subscription_id, resource_type, policy))
+                impacted_resources.append(
                     {
                         "SubscriptionId": subscription_id,
                         "Policy": policy["name"],
-                        "ResourceType": "Public IP",
+                        "Resource": public_ip.name,
+                        "ResourceId": public_ip.id,
+                        "Actions": ", ".join([action["type"] for action in actions]),
+                        "Owner": owner,
                     }
                 )
+                resources_impacted = True
+
+        if not resources_impacted:
+            non_impacted_resources.append(
+                {
+                    "SubscriptionId": subscription_id,
+                    "Policy": policy["name"],
+                    "ResourceType": "Public IP",
+                }
+            )
 
-        elif resource_type == "azure.sql":
-            servers = sql_client.servers.list()
-            for server in servers:
-                resource_group_name = server.id.split("/")[4]
-                databases = sql_client.databases.list_by_server(resource_group_name, server.name)
-                for db in databases:
-                    logger.info(f"Database: {db.name}, Current DTU: {db.sku.capacity}")
-                    owner = get_owner_tag(db)
-                    status, message = scale_sql_database(db, policy["actions"][0]["tiers"], status_log, dry_run, subscription_id)
-                    if status != "No Change":
-                        impacted_resources.append(
-                            {
-                                "SubscriptionId": subscription_id,
-                                "Policy": policy["name"],
-                                "Resource": db.name,
-                                "Actions": "scale",
-                                "Status": status,
-                                "Message": message,
-                                "Owner": owner,
-                            }
-                        )
-                        resources_impacted = True
-            if not resources_impacted:
-                non_impacted_resources.append(
+    elif resource_type == "azure.sql":
+        for db, status, message in scale_sql_fleet(list_resources("azure.sql"), policy["actions"][0]["tiers"], status_log, dry_run, subscription_id):
+            owner = get_owner_tag(db)
+            if status != "No Change":
+                impacted_resources.append(
                     {
                         "SubscriptionId": subscription_id,
                         "Policy": policy["name"],
-                        "ResourceType": "SQL Database",
+                        "Resource": db.name,
+                        "ResourceId": db.id,
+                        "Actions": "scale",
+                        "Status": status,
+                        "Message": message,
+                        "Owner": owner,
                     }
                 )
-
-        elif resource_type == "azure.applicationgateway":
-            policy_results = review_application_gateways([policy], status_log, dry_run=dry_run)
-            impacted_resources.extend([{"SubscriptionId": subscription_id, **res} for res in policy_results])
-            if policy_results:
                 resources_impacted = True
-            else:
-                non_impacted_resources.append(
+        if not resources_impacted:
+            non_impacted_resources.append(
+                {
+                    "SubscriptionId": subscription_id,
+                    "Policy": policy["name"],
+                    "ResourceType": "SQL Database",
+                }
+            )
+
+    elif resource_type == "azure.applicationgateway":
+        policy_results = review_application_gateways([policy], status_log, dry_run=dry_run)
+        impacted_resources.extend([{"SubscriptionId": subscription_id, **res} for res in policy_results])
+        if policy_results:
+            resources_impacted = True
+        else:
+            non_impacted_resources.append(
+                {
+                    "SubscriptionId": subscription_id,
+                    "Policy": policy["name"],
+                    "ResourceType": "Application Gateway",
+                }
+            )
+
+    elif resource_type == "azure.nic":
+        nics = skip_converged_resources(list_resources("azure.nic"), actions)
+        for nic in nics:
+            if not evaluate_exclusions(nic, exclusions) and evaluate_filters(nic, filters):
+                owner = get_owner_tag(nic)
+                action_futures.append(submit_actions(nic, actions, status_log, dry_run, subscription_id, resource_type, policy))
+                impacted_resources.append(
                     {
                         "SubscriptionId": subscription_id,
                         "Policy": policy["name"],
-                        "ResourceType": "Application Gateway",
+                        "Resource": nic.name,
+                        "ResourceId": nic.id,
+                        "Actions": ", ".join([action["type"] for action in actions]),
+                        "Owner": owner,
                     }
                 )
+                resources_impacted = True
+        if not resources_impacted:
+            non_impacted_resources.append(
+                {
+                    "SubscriptionId": subscription_id,
+                    "Policy": policy["name"],
+                    "ResourceType": "Network Interface",
+                }
+            )
+
+    wait_for_actions(action_futures)
 
+def submit_actions(resource, actions, status_log, dry_run, subscription_id, resource_type, policy=None):
+    """Start the actions of a resource without waiting for them to finish and return their future."""
+    if dry_run:
+        if policy and get_run_context().plan is not None:
+            record_plan_entry(policy, resource, subscription_id)
+        apply_actions(resource, actions, status_log, dry_run, subscription_id)
+        future = Future()
+        future.set_result(None)
+        return future
+    clients = get_clients()
+    with clients.inventory_lock:
+        if resource_type not in clients.action_executors:
+            clients.action_executors[resource_type] = ThreadPoolExecutor(max_workers=get_run_context().max_parallel_actions_per_type)
+        executor = clients.action_executors[resource_type]
+    return executor.submit(contextvars.copy_context().run, run_actions, resource, actions, status_log, dry_run, subscription_id)
+
+def record_plan_entry(policy, resource, subscription_id):
+    """Add a matched resource, its actions and the evidence it was selected on to the plan of the run."""
+    plan = get_run_context().plan
+    entry = {
+        "SubscriptionId": subscription_id,
+        "Policy": policy["name"],
+        "ResourceType": policy["resource"],
+        "ResourceId": resource.id,
+        "Resource": resource.name,
+        "ETag": getattr(resource, "etag", None),
+        "Owner": get_owner_tag(resource),
+        "Actions": policy["actions"],
+        "Filters": policy["filters"],
+        "Exclusions": policy.get("exclusions", []),
+        "Evidence": get_plan_evidence(resource, policy["filters"]),
+    }
+    with plan.lock:
+        plan.entries.append(entry)
+
+def get_plan_evidence(resource, filters):
+    """Return the facts a matched resource was selected on, read from the data gathered while evaluating its filters."""
+    evidence = {}
+    for filter in filters:
+        filter_type = filter["type"]
+        if filter_type == "last_used":
+            # Served from the CPU usage prefetched for the filter
+            last_used_date, avg_cpu = get_last_used_date(resource, filter["days"], filter.get("threshold", 10))
+            evidence["LastUsed"] = {"Days": filter["days"], "LastUsedDate": last_used_date.isoformat(), "AverageCpu": round(avg_cpu, 2)}
+        elif filter_type == "unattached":
+            # Served from the reference graph built while evaluating the filter
+            evidence["AttachedTo"] = sorted(get_attachments(resource, get_reference_graph()))
+        elif filter_type == "tag":
+            evidence[f"Tag:{filter['key']}"] = resource.tags.get(filter["key"])
+        elif filter_type == "sku":
+            evidence["Sku"] = resource.sku.name
+        elif filter_type == "stopped":
+            evidence["PowerState"] = get_power_state(resource)
+    return evidence
+
+def write_plan(plan_file):
+    """Write the plan gathered by a dry run to a JSON file."""
+    plan = get_run_context().plan
+    entries = sorted(plan.entries, key=lambda entry: (entry["SubscriptionId"], entry["Policy"], entry["ResourceId"].lower()))
+    with open(plan_file, "w") as f:
+        json.dump({"CreatedAt": datetime.now(timezone.utc).isoformat(), "Actions": entries}, f, indent=2)
+    logger.info(f"Plan with {len(entries)} resource(s) written to {plan_file}")
+
+def load_plan(plan_file):
+    """Load a plan written by a dry run with --plan-out."""
+    with open(plan_file, "r") as f:
+        plan = json.load(f)
+    logger.info(f"Loaded plan created at {plan['CreatedAt']} with {len(plan['Actions'])} resource(s) from {plan_file}")
+    return plan
+
+def get_resource(resource_type, resource_id):
+    """Read the current state of a resource of a policy resource type, or None if it no longer exists."""
+    clients = get_clients()
+    resource_group_name = resource_id.split("/")[4]
+    name = resource_id.split("/")[-1]
+    try:
+        if resource_type == "azure.vm":
+            return clients.compute_client.virtual_machines.get(resource_group_name, name)
+        elif resource_type == "azure.disk":
+            return clients.compute_client.disks.get(resource_group_name, name)
+        elif resource_type == "azure.resourcegroup":
+            return clients.resource_client.resource_groups.get(name)
+        elif resource_type == "azure.storage":
+            return clients.storage_client.storage_accounts.get_properties(resource_group_name, name)
+        elif resource_type == "azure.publicip":
+            return clients.network_client.public_ip_addresses.get(resource_group_name, name)
         elif resource_type == "azure.nic":
-            nics = network_client.network_interfaces.list_all()
-            for nic in nics:
-                if not evaluate_exclusions(nic, exclusions) and evaluate_filters(nic, filters):
-                    owner = get_owner_tag(nic)
-                    apply_actions(nic, actions, status_log, dry_run, subscription_id)
-                    impacted_resources.append(
+            return clients.network_client.network_interfaces.get(resource_group_name, name)
+    except ResourceNotFoundError:
+        return None
+    raise ValueError(f"Unsupported resource type in plan: {resource_type}")
+
+def revalidate_plan_entry(entry, resource, reference_graph):
+    """Check that a planned resource is unchanged since the dry run, without re-reading metrics."""
+    if resource is None:
+        return False, "Resource no longer exists."
+    if entry["ETag"] and getattr(resource, "etag", None) != entry["ETag"]:
+        return False, f"Resource changed since the plan was made (ETag {entry['ETag']} is now {getattr(resource, 'etag', None)})."
+    if evaluate_exclusions(resource, entry["Exclusions"]):
+        return False, "Resource is now excluded."
+    for filter in entry["Filters"]:
+        filter_type = filter["type"]
+        # The last_used evidence comes from the dry run, the other filters are cheap to evaluate again
+        # from the subscription reference graph and power-state index
+        if filter_type == "unattached" and get_attachments(resource, reference_graph):
+            return False, "Resource is no longer unattached."
+        elif filter_type == "tag" and not tag_filter(resource, filter["key"], filter["value"]):
+            return False, f"Tag {filter['key']} no longer matches."
+        elif filter_type == "sku" and not sku_filter(resource, filter["values"]):
+            return False, f"SKU {resource.sku.name} no longer matches."
+        elif filter_type == "stopped" and not is_vm_stopped(resource):
+            return False, "VM is no longer stopped (deallocated)."
+    return True, None
+
+def apply_subscription_plan(subscription_id, entries, impacted_resources, status_log):
+    """Revalidate and apply the planned actions of one subscription."""
+    client_context.set(create_subscription_clients(subscription_id))
+    logger.info(f"Applying {len(entries)} planned resource(s) in subscription {subscription_id}")
+    action_futures = []
+    try:
+        # The reference graph is built once for the subscription and only when an entry has an unattached filter
+        reference_graph = get_reference_graph() if any(filter["type"] == "unattached" for entry in entries for filter in entry["Filters"]) else {}
+        for entry in entries:
+            try:
+                resource = get_resource(entry["ResourceType"], entry["ResourceId"])
+                valid, message = revalidate_plan_entry(entry, resource, reference_graph)
+            except Exception as e:
+                # An entry that cannot be revalidated is skipped, the rest of the plan still applies
+                logger.error(f"Failed to revalidate planned resource {entry['Resource']}: {e}")
+                valid, message = False, f"Could not revalidate the resource: {e}"
+            if not valid:
+                logger.info(f"Skipping planned resource {entry['Resource']}: {message}")
+                for action in entry["Actions"]:
+                    status_log.append(
                         {
                             "SubscriptionId": subscription_id,
-                            "Policy": policy["name"],
-                            "Resource": nic.name,
-                            "Actions": ", ".join([action["type"] for action in actions]),
-                            "Owner": owner,
+                            "Resource": entry["Resource"],
+                            "Action": action["type"],
+                            "Status": "Skipped",
+                            "Message": message,
                         }
                     )
-                    resources_impacted = True
-            if not resources_impacted:
-                non_impacted_resources.append(
-                    {
-                        "SubscriptionId": subscription_id,
-                        "Policy": policy["name"],
-                        "ResourceType": "Network Interface",
-                    }
-                )
+                continue
+            action_futures.append(submit_actions(resource, entry["Actions"], status_log, False, subscription_id, entry["ResourceType"]))
+            impacted_resources.append(
+                {
+                    "SubscriptionId": subscription_id,
+                    "Policy": entry["Policy"],
+                    "Resource": entry["Resource"],
+                    "ResourceId": entry["ResourceId"],
+                    "Actions": ", ".join([action["type"] for action in entry["Actions"]]),
+                    "Owner": entry["Owner"],
+                }
+            )
+        wait_for_actions(action_futures)
+    except Exception as e:
+        logger.error(f"Error applying plan in subscription {subscription_id}: {e}")
+        tc.track_exception()
+    finally:
+        close_action_executors()
+        tc.flush()
+
+def apply_plan(plan, max_parallel_subscriptions=1):
+    """Apply a plan with a bounded worker pool and return the results in subscription order."""
+    entries_by_subscription = defaultdict(list)
+    for entry in plan["Actions"]:
+        entries_by_subscription[entry["SubscriptionId"]].append(entry)
+
+    def worker(subscription_id):
+        result = {
+            "summary_reports": [],
+            "impacted_resources": [],
+            "non_impacted_resources": [],
+            "status_log": [],
+            "policy_timings": [],
+            "daily_costs": [],
+        }
+        apply_subscription_plan(subscription_id, entries_by_subscription[subscription_id], result["impacted_resources"], result["status_log"])
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel_subscriptions)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, worker, subscription_id) for subscription_id in entries_by_subscription]
+        return [future.result() for future in futures]
+
+def capture_subscription_snapshot(subscription_id, metrics_days):
+    """Capture the inventory, power states, CPU usage and cost rows of a subscription for offline simulation."""
+    client_context.set(create_subscription_clients(subscription_id))
+    try:
+        clients = get_clients()
+        resources = {resource_type: [resource.serialize(keep_readonly=True) for resource in list_resources(resource_type)] for resource_type in SNAPSHOT_RESOURCE_TYPES}
+        vms = list_resources("azure.vm")
+        prefetch_cpu_usage(vms, metrics_days)
+        cpu_usage = {}
+        for vm in vms:
+            _, points = clients.cpu_usage.get((vm.id.lower(), metrics_days), (None, []))
+            cpu_usage[vm.id.lower()] = [(time_stamp.isoformat(), average) for time_stamp, average in points]
+        cost_data = get_cost_data(f'/subscriptions/{subscription_id}')
+        logger.info(f"Captured {sum(len(items) for items in resources.values())} resources of subscription {subscription_id}")
+        return {
+            "Resources": resources,
+            "PowerStates": get_power_states(),
+            "CpuUsage": cpu_usage,
+            "CostRows": cost_data.rows if cost_data else None,
+        }
+    finally:
+        close_action_executors()
+
+def write_snapshot(snapshot_file, subscriptions, policies, max_parallel_subscriptions=1):
+    """Capture the subscriptions into a snapshot file that policies can be simulated against without Azure."""
+    metrics_days = max([SNAPSHOT_METRICS_DAYS] + [filter["days"] for policy in policies for filter in policy["filters"] if filter["type"] == "last_used"])
+    captured_at = datetime.now(timezone.utc).replace(microsecond=0)
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel_subscriptions)) as executor:
+        futures = {
+            subscription.subscription_id: executor.submit(contextvars.copy_context().run, capture_subscription_snapshot, subscription.subscription_id, metrics_days)
+            for subscription in subscriptions
+        }
+        snapshot = {
+            "CapturedAt": captured_at.isoformat(),
+            "MetricsDays": metrics_days,
+            "Subscriptions": {subscription_id: future.result() for subscription_id, future in futures.items()},
+        }
+    os.makedirs(os.path.dirname(snapshot_file) or ".", exist_ok=True)
+    with open(snapshot_file, "w") as f:
+        json.dump(snapshot, f)
+    logger.info(f"Snapshot of {len(snapshot['Subscriptions'])} subscription(s) written to {snapshot_file}")
+
+def load_snapshot(snapshot_file):
+    """Load a snapshot written by write_snapshot."""
+    with open(snapshot_file, "r") as f:
+        snapshot = json.load(f)
+    logger.info(f"Loaded snapshot captured at {snapshot['CapturedAt']} with {len(snapshot['Subscriptions'])} subscription(s) from {snapshot_file}")
+    return snapshot
+
+def simulate_subscription(subscription_id, snapshot, policies, max_parallel_policies=1):
+    """Evaluate policies as a dry run against the snapshot of a subscription."""
+    result = {
+        "summary_reports": [],
+        "impacted_resources": [],
+        "non_impacted_resources": [],
+        "status_log": [],
+        "policy_timings": [],
+        "daily_costs": [],
+    }
+    subscription_snapshot = snapshot["Subscriptions"][subscription_id]
+    clients = create_subscription_clients(subscription_id)
+    client_context.set(clients)
+    try:
+        for resource_type, items in subscription_snapshot["Resources"].items():
+            model = get_resource_model(resource_type)
+            clients.inventory[resource_type] = [model.deserialize(item) for item in items]
+        clients.power_states = dict(subscription_snapshot["PowerStates"])
+
+        # The last_used windows of the policies are cut from the captured series, so prefetch finds them cached
+        captured_at = datetime.fromisoformat(snapshot["CapturedAt"])
+        cpu_usage = {
+            resource_id: [(datetime.fromisoformat(time_stamp), average) for time_stamp, average in points]
+            for resource_id, points in subscription_snapshot["CpuUsage"].items()
+        }
+        for days in {filter["days"] for policy in policies for filter in policy["filters"] if filter["type"] == "last_used"}:
+            if days > snapshot["MetricsDays"]:
+                logger.warning(f"The snapshot holds {snapshot['MetricsDays']} days of CPU usage, last_used filters over {days} days only see those")
+            start_time = captured_at - timedelta(days=days)
+            for vm in clients.inventory["azure.vm"]:
+                points = [(time_stamp, average) for time_stamp, average in cpu_usage.get(vm.id.lower(), []) if time_stamp >= start_time]
+                clients.cpu_usage[(vm.id.lower(), days)] = (start_time.isoformat().replace("+00:00", "Z"), points)
+
+        if subscription_snapshot["CostRows"]:
+            analyze_cost_data(SimpleNamespace(rows=subscription_snapshot["CostRows"]), subscription_id, result["summary_reports"], result["daily_costs"])
+        apply_policies(policies, True, subscription_id, result["impacted_resources"], result["non_impacted_resources"], result["status_log"], max_parallel_policies, result["policy_timings"])
+    except Exception as e:
+        # A subscription whose snapshot cannot be evaluated must not discard the results of the others
+        logger.error(f"Error simulating subscription {subscription_id}: {e}")
+        tc.track_exception(properties={"SubscriptionId": subscription_id})
+        result = {key: [] for key in result}
+    finally:
+        close_action_executors()
+    return result
+
+def simulate(snapshot, policies, max_parallel_subscriptions=1, max_parallel_policies=1):
+    """Evaluate policies against every subscription of a snapshot and return their results in snapshot order."""
+    simulation_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel_subscriptions)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, simulate_subscription, subscription_id, snapshot, policies, max_parallel_policies) for subscription_id in snapshot["Subscriptions"]]
+        results = [future.result() for future in futures]
+    logger.info(f"Simulated {len(policies)} policies against {len(results)} subscription(s) in {time.perf_counter() - simulation_start:.2f} seconds")
+    return results
+
+def run_actions(resource, actions, status_log, dry_run, subscription_id):
+    """Apply the actions of a resource once the subscription has a free action slot."""
+    # Each worker waits on its own poller, status_log is written as each operation completes
+    with get_clients().action_slots:
+        action_log = []
+        apply_actions(resource, actions, action_log, dry_run, subscription_id)
+        status_log.extend(action_log)
+    if get_run_context().state_store:
+        try:
+            record_desired_state(resource, actions, action_log)
+        except Exception as e:
+            logger.error(f"Failed to record the desired state of {resource.name}: {e}")
+
+def wait_for_actions(action_futures):
+    """Wait for started actions to finish."""
+    for future in action_futures:
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"Failed to apply actions: {e}")
+
+def close_action_executors():
+    """Shut down the action executors of the current subscription once their actions are done."""
+    for executor in get_clients().action_executors.values():
+        executor.shutdown()
 
 def get_owner_tag(resource):
     """Retrieve the owner tag from the resource."""
     tags = resource.tags
     return tags.get('Owner') if tags else None
 
-def process_subscription(subscription, mode, summary_reports, impacted_resources, non_impacted_resources, status_log, start_date, end_date, use_adls=False):
+def process_subscription(subscription, mode, summary_reports, impacted_resources, non_impacted_resources, status_log, start_date, end_date, use_adls=False, max_parallel_policies=1, policy_timings=None, daily_costs=None):
     """Process a subscription for cost optimization."""
-    global resource_client, cost_management_client, compute_client, storage_client, network_client, sql_client
-    
     subscription_id = subscription.subscription_id
-    resource_client = ResourceManagementClient(credential, subscription_id)
-    cost_management_client = CostManagementClient(credential)
-    compute_client = ComputeManagementClient(credential, subscription_id)
-    storage_client = StorageManagementClient(credential, subscription_id)
-    network_client = NetworkManagementClient(credential, subscription_id)
-    sql_client = SqlManagementClient(credential, subscription_id)
+    client_context.set(create_subscription_clients(subscription_id))
 
     logger.info(f'Processing subscription: {subscription_id}')
     tc.track_event("SubscriptionProcessingStarted", {"SubscriptionId": subscription_id})
@@ -1294,8 +2985,10 @@ def process_subscription(subscription, mode, summary_reports, impacted_resources
         policies = load_policies(policy_file, schema_file)
         cost_data = get_cost_data(f'/subscriptions/{subscription_id}')
         if cost_data:
-            analyze_cost_data(cost_data, subscription_id, summary_reports)
-        apply_policies(policies, mode == 'dry-run', subscription_id=subscription_id, impacted_resources=impacted_resources, non_impacted_resources=non_impacted_resources, status_log=status_log)
+            analyze_cost_data(cost_data, subscription_id, summary_reports, daily_costs)
+        policies_start = time.perf_counter()
+        apply_policies(policies, mode == 'dry-run', subscription_id=subscription_id, impacted_resources=impacted_resources, non_impacted_resources=non_impacted_resources, status_log=status_log, max_parallel_policies=max_parallel_policies, policy_timings=policy_timings)
+        logger.info(f"Policies for subscription {subscription_id} applied in {time.perf_counter() - policies_start:.2f} seconds")
         tc.flush()
 
         return {}
@@ -1304,8 +2997,410 @@ def process_subscription(subscription, mode, summary_reports, impacted_resources
         tc.track_exception()
         tc.flush()
         return {}
+    finally:
+        close_action_executors()
+
+def process_subscriptions(subscriptions, mode, start_date, end_date, use_adls=False, max_parallel_subscriptions=1, max_parallel_policies=1):
+    """Process subscriptions with a bounded worker pool and return their results in subscription order."""
+    def worker(subscription):
+        result = {
+            "summary_reports": [],
+            "impacted_resources": [],
+            "non_impacted_resources": [],
+            "status_log": [],
+            "policy_timings": [],
+            "daily_costs": [],
+        }
+        process_subscription(subscription, mode, result["summary_reports"], result["impacted_resources"], result["non_impacted_resources"], result["status_log"], start_date, end_date, use_adls, max_parallel_policies, result["policy_timings"], result["daily_costs"])
+        return result
+
+    logger.info(f"Processing {len(subscriptions)} subscription(s) with up to {max_parallel_subscriptions} in parallel.")
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel_subscriptions)) as executor:
+        # Each worker gets a copy of the current context so its clients stay private to it
+        futures = [executor.submit(contextvars.copy_context().run, worker, subscription) for subscription in subscriptions]
+        return [future.result() for future in futures]
+
+# Async engine: drives the same policies through the azure.mgmt.*.aio clients on one event loop.
+# Reads (listing, instance views, metrics) are issued concurrently, bounded by a single semaphore.
+async_client_context = contextvars.ContextVar("async_client_context")
+
+RESOURCE_TYPE_NAMES = {
+    "azure.vm": "VM",
+    "azure.disk": "Disk",
+    "azure.resourcegroup": "Resource Group",
+    "azure.storage": "Storage Account",
+    "azure.publicip": "Public IP",
+    "azure.sql": "SQL Database",
+    "azure.applicationgateway": "Application Gateway",
+    "azure.nic": "Network Interface",
+}
+
+def create_async_subscription_clients(async_credential, subscription_id, transport, request_semaphore):
+    """Create the async ARM clients used to process a single subscription."""
+    client_kwargs = {"transport": transport, "retry_policy": AsyncTransientRetryPolicy(), "per_retry_policies": [AsyncRateLimitPolicy(get_run_context().rate_limit_governor)]}
+    return SimpleNamespace(
+        subscription_id=subscription_id,
+        request_semaphore=request_semaphore,
+        resource_client=AsyncResourceManagementClient(async_credential, subscription_id, **client_kwargs),
+        compute_client=AsyncComputeManagementClient(async_credential, subscription_id, **client_kwargs),
+        storage_client=AsyncStorageManagementClient(async_credential, subscription_id, **client_kwargs),
+        network_client=AsyncNetworkManagementClient(async_credential, subscription_id, **client_kwargs),
+        sql_client=AsyncSqlManagementClient(async_credential, subscription_id, **client_kwargs),
+        inventory={},
+    )
 
-def main(mode, all_subscriptions, use_adls=False):
+async def close_async_subscription_clients(clients):
+    """Close the async ARM clients of a subscription."""
+    for client in (clients.resource_client, clients.compute_client, clients.storage_client, clients.network_client, clients.sql_client):
+        await client.close()
+
+def get_async_clients():
+    """Return the async ARM clients of the subscription processed in the current task."""
+    return async_client_context.get()
+
+async def async_list(pager):
+    """Collect all pages of an async pager while holding a request slot."""
+    async with get_async_clients().request_semaphore:
+        return [item async for item in pager]
+
+async def async_call(coroutine):
+    """Await a single ARM read while holding a request slot."""
+    async with get_async_clients().request_semaphore:
+        return await coroutine
+
+def async_resource_pager(resource_type):
+    """Return the async pager listing all resources of a policy resource type."""
+    clients = get_async_clients()
+    if resource_type == "azure.vm":
+        return clients.compute_client.virtual_machines.list_all()
+    elif resource_type == "azure.disk":
+        return clients.compute_client.disks.list()
+    elif resource_type == "azure.resourcegroup":
+        return clients.resource_client.resource_groups.list()
+    elif resource_type == "azure.storage":
+        return clients.storage_client.storage_accounts.list()
+    elif resource_type == "azure.publicip":
+        return clients.network_client.public_ip_addresses.list_all()
+    elif resource_type == "azure.applicationgateway":
+        return clients.network_client.application_gateways.list_all()
+    elif resource_type == "azure.nic":
+        return clients.network_client.network_interfaces.list_all()
+    elif resource_type == "azure.loadbalancer":
+        return clients.network_client.load_balancers.list_all()
+    elif resource_type == "azure.natgateway":
+        return clients.network_client.nat_gateways.list_all()
+    raise ValueError(f"Unsupported resource type: {resource_type}")
+
+async def async_list_resources(resource_type):
+    """Return the resources of a type for the current subscription, listing them once per run on first use."""
+    inventory = get_async_clients().inventory
+    if resource_type not in inventory:
+        # Policies evaluated concurrently await the same listing task
+        if get_run_context().resource_graph and resource_type in RESOURCE_GRAPH_TYPES:
+            inventory[resource_type] = asyncio.ensure_future(asyncio.to_thread(list_resources_from_resource_graph, resource_type))
+        else:
+            inventory[resource_type] = asyncio.ensure_future(async_list_resources_from_arm(resource_type))
+    return await inventory[resource_type]
+
+async def async_list_resources_from_arm(resource_type):
+    """List all resources of a policy resource type through the async clients."""
+    if resource_type == "azure.sql":
+        sql_client = get_async_clients().sql_client
+        servers = await async_list(sql_client.servers.list())
+        databases_by_server = await asyncio.gather(
+            *(async_list(sql_client.databases.list_by_server(server.id.split("/")[4], server.name)) for server in servers)
+        )
+        return [db for databases in databases_by_server for db in databases]
+    return await async_list(async_resource_pager(resource_type))
+
+async def async_get_power_states():
+    """Return the power state of every VM in the current subscription, indexed by lower-cased VM id."""
+    inventory = get_async_clients().inventory
+    if "power_states" not in inventory:
+        inventory["power_states"] = asyncio.ensure_future(async_list_power_states())
+    return await inventory["power_states"]
+
+async def async_list_power_states():
+    """Build the power-state index of the current subscription from one status-only listing."""
+    vms = await async_list(get_async_clients().compute_client.virtual_machines.list_all(status_only="true"))
+    return {vm.id.lower(): get_power_state_code(vm.instance_view.statuses if vm.instance_view else None) for vm in vms}
+
+async def async_is_vm_stopped(vm):
+    """Check if a VM is stopped (deallocated)."""
+    power_states = await async_get_power_states()
+    if vm.id.lower() in power_states:
+        return power_states[vm.id.lower()] == 'PowerState/deallocated'
+    resource_group_name = vm.id.split("/")[4]
+    vm_instance_view = await async_call(get_async_clients().compute_client.virtual_machines.instance_view(resource_group_name, vm.name))
+    return get_power_state_code(vm_instance_view.statuses) == 'PowerState/deallocated'
+
+async def async_get_last_used_date(resource, days, threshold=5):
+    """Get the last used date and average CPU usage of a VM, see get_last_used_date."""
+    if (resource.id.lower(), days) in get_clients().cpu_usage:
+        return get_last_used_date(resource, days, threshold)
+    return await asyncio.to_thread(get_last_used_date, resource, days, threshold)
+
+async def async_get_reference_graph():
+    """Return the reference graph of the current subscription, see get_reference_graph."""
+    inventory = get_async_clients().inventory
+    if "reference_graph" not in inventory:
+        inventory["reference_graph"] = asyncio.ensure_future(async_build_reference_graph())
+    return await inventory["reference_graph"]
+
+async def async_build_reference_graph():
+    """Build the reference graph of the current subscription from the async inventory."""
+    listings = await asyncio.gather(*(async_list_resources(resource_type) for resource_type in REFERENCE_GRAPH_TYPES))
+    return build_reference_graph(resource for resources in listings for resource in resources)
+
+async def async_share_indexes(power_states=False, reference_graph=False):
+    """Hand the async power-state index and reference graph to the synchronous clients, so helpers run on worker threads reuse them."""
+    clients = get_clients()
+    if power_states and clients.power_states is None:
+        clients.power_states = await async_get_power_states()
+    if reference_graph and clients.reference_graph is None:
+        clients.reference_graph = await async_get_reference_graph()
+
+async def async_unattached_filter(resource):
+    """Check if a resource is unattached, see unattached_filter."""
+    return not get_attachments(resource, await async_get_reference_graph())
+
+async def async_evaluate_filters(resource, filters):
+    """Evaluate if a resource meets the defined filters, see evaluate_filters."""
+    for filter in filters:
+        filter_type = filter["type"]
+        if filter_type == "last_used":
+            days = filter["days"]
+            threshold = filter.get("threshold", 10)
+            last_used_date, avg_cpu = await async_get_last_used_date(resource, days, threshold)
+            if not is_idle(resource, last_used_date, avg_cpu, days, threshold):
+                logger.info(f"Resource {resource.name} does not meet last_used filter with threshold {threshold}")
+                return False
+        elif filter_type == "unattached":
+            if not await async_unattached_filter(resource):
+                logger.info(f"Resource {resource.name} does not meet unattached filter")
+                return False
+        elif filter_type == "tag":
+            if not tag_filter(resource, filter["key"], filter["value"]):
+                logger.info(f"Resource {resource.name} does not meet tag filter")
+                return False
+        elif filter_type == "sku":
+            if not sku_filter(resource, filter["values"]):
+                logger.info(f"Resource {resource.name} does not meet sku filter")
+                return False
+        elif filter_type == "stopped":
+            if not await async_is_vm_stopped(resource):
+                logger.info(f"Resource {resource.name} is not stopped (deallocated)")
+                return False
+    logger.info(f"Resource {resource.name} meets all filters")
+    return True
+
+async def async_apply_policy(policy, dry_run, subscription_id, impacted_resources, non_impacted_resources, status_log):
+    """Apply a single policy to resources using the async clients."""
+    resource_type = policy["resource"]
+    filters = policy["filters"]
+    actions = policy["actions"]
+    exclusions = policy.get("exclusions", [])
+
+    resources_impacted = False
+
+    if resource_type == "azure.sql":
+        databases = await async_list_resources("azure.sql")
+        for db, status, message in await asyncio.to_thread(scale_sql_fleet, databases, policy["actions"][0]["tiers"], status_log, dry_run, subscription_id):
+            owner = get_owner_tag(db)
+            if status != "No Change":
+                impacted_resources.append(
+                    {
+                        "SubscriptionId": subscription_id,
+                        "Policy": policy["name"],
+                        "Resource": db.name,
+                        "ResourceId": db.id,
+                        "Actions": "scale",
+                        "Status": status,
+                        "Message": message,
+                        "Owner": owner,
+                    }
+                )
+                resources_impacted = True
+
+    elif resource_type == "azure.applicationgateway":
+        gateways = await async_list_resources(resource_type)
+        network_client = get_clients().network_client
+        for gateway in gateways:
+            if not gateway.backend_address_pools or any(not pool.backend_addresses for pool in gateway.backend_address_pools):
+                # The gateway filters use the synchronous clients, they run on a worker thread to keep the loop free
+                if await asyncio.to_thread(evaluate_filters, gateway, filters):
+                    try:
+                        status, message = await asyncio.to_thread(apply_app_gateway_actions, network_client, gateway, actions, status_log, dry_run)
+                        if status != "No Change":
+                            impacted_resources.append(
+                                {
+                                    "SubscriptionId": subscription_id,
+                                    "Policy": policy["name"],
+                                    "Resource": gateway.name,
+                                    "ResourceId": gateway.id,
+                                    "Actions": ", ".join([action["type"] for action in actions]),
+                                    "Status": status,
+                                    "Message": message,
+                                }
+                            )
+                            resources_impacted = True
+                    except Exception as e:
+                        logger.error(f"Failed to apply actions: {e}")
+
+    else:
+        resources = await async_list_resources(resource_type)
+        if resource_type == "azure.vm" and get_run_context().state_store:
+            # The VM fingerprints read the power-state index, seed it from the async listing before the worker thread needs it
+            await async_share_indexes(power_states=True)
+        resources = await asyncio.to_thread(skip_converged_resources, resources, actions)
+        if resource_type == "azure.vm":
+            # The batch metrics queries are few, they reuse the synchronous prefetch on a worker thread
+            candidates = [vm for vm in resources if not evaluate_exclusions(vm, exclusions)]
+            for filter in filters:
+                if filter["type"] == "last_used":
+                    await asyncio.to_thread(prefetch_cpu_usage, candidates, filter["days"])
+
+        async def evaluate(resource):
+            logger.info(f"Evaluating {RESOURCE_TYPE_NAMES[resource_type]} {resource.name}")
+            return not evaluate_exclusions(resource, exclusions) and await async_evaluate_filters(resource, filters)
+
+        # All resources of the policy are evaluated concurrently, results keep the listing order
+        matches = await asyncio.gather(*(evaluate(resource) for resource in resources))
+        # The plan evidence reads the indexes the async filters built, the synchronous helpers must not list them again
+        await async_share_indexes(
+            power_states=any(filter["type"] == "stopped" for filter in filters),
+            reference_graph=any(filter["type"] == "unattached" for filter in filters),
+        )
+        action_futures = []
+        for resource, matched in zip(resources, matches):
+            if matched:
+                owner = get_owner_tag(resource)
+                # Write operations reuse the synchronous action executors of the subscription, dry runs apply on the worker thread
+                action_futures.append(await asyncio.to_thread(submit_actions, resource, actions, status_log, dry_run, subscription_id, resource_type, policy))
+                impacted_resources.append(
+                    {
+                        "SubscriptionId": subscription_id,
+                        "Policy": policy["name"],
+                        "Resource": resource.name,
+                        "ResourceId": resource.id,
+                        "Actions": ", ".join([action["type"] for action in actions]),
+                        "Owner": owner,
+                    }
+                )
+                resources_impacted = True
+        await asyncio.to_thread(wait_for_actions, action_futures)
+
+    if not resources_impacted:
+        non_impacted_resources.append(
+            {
+                "SubscriptionId": subscription_id,
+                "Policy": policy["name"],
+                "ResourceType": RESOURCE_TYPE_NAMES[resource_type],
+            }
+        )
+
+async def async_apply_policies(policies, dry_run, subscription_id, impacted_resources, non_impacted_resources, status_log, policy_timings=None):
+    """Apply all policies of a subscription concurrently on the event loop."""
+    async def run_policy(policy):
+        result = {
+            "impacted_resources": [],
+            "non_impacted_resources": [],
+            "status_log": [],
+        }
+        policy_start = time.perf_counter()
+        try:
+            await async_apply_policy(policy, dry_run, subscription_id, result["impacted_resources"], result["non_impacted_resources"], result["status_log"])
+        except Exception as e:
+            logger.error(f"Error in policy {policy['name']} for subscription {subscription_id}: {e}")
+            tc.track_exception(properties={"SubscriptionId": subscription_id, "Policy": policy["name"]})
+            result.update(impacted_resources=[], non_impacted_resources=[], status_log=[])
+        result["duration"] = time.perf_counter() - policy_start
+        return result
+
+    results = await asyncio.gather(*(run_policy(policy) for policy in policies))
+
+    for policy, result in zip(policies, results):
+        impacted_resources.extend(result["impacted_resources"])
+        non_impacted_resources.extend(result["non_impacted_resources"])
+        status_log.extend(result["status_log"])
+        logger.info(f"Policy {policy['name']} completed in {result['duration']:.2f} seconds for subscription {subscription_id}")
+        tc.track_metric("PolicyDuration", result["duration"], properties={"SubscriptionId": subscription_id, "Policy": policy["name"]})
+        if policy_timings is not None:
+            policy_timings.append(
+                {
+                    "SubscriptionId": subscription_id,
+                    "Policy": policy["name"],
+                    "ResourceType": policy["resource"],
+                    "Duration": result["duration"],
+                }
+            )
+
+async def async_process_subscription(subscription, mode, async_credential, transport, request_semaphore, summary_reports, impacted_resources, non_impacted_resources, status_log, policy_timings=None, daily_costs=None):
+    """Process a subscription for cost optimization using the async engine."""
+    subscription_id = subscription.subscription_id
+    # Synchronous clients are still used for write operations and cost queries
+    client_context.set(create_subscription_clients(subscription_id))
+    async_clients = create_async_subscription_clients(async_credential, subscription_id, transport, request_semaphore)
+    async_client_context.set(async_clients)
+
+    logger.info(f'Processing subscription: {subscription_id}')
+    tc.track_event("SubscriptionProcessingStarted", {"SubscriptionId": subscription_id})
+
+    try:
+        policy_file = config['policies']['policy_file']
+        schema_file = config['policies']['schema_file']
+        policies = load_policies(policy_file, schema_file)
+        cost_data = await asyncio.to_thread(get_cost_data, f'/subscriptions/{subscription_id}')
+        if cost_data:
+            await asyncio.to_thread(analyze_cost_data, cost_data, subscription_id, summary_reports, daily_costs)
+        policies_start = time.perf_counter()
+        await async_apply_policies(policies, mode == 'dry-run', subscription_id, impacted_resources, non_impacted_resources, status_log, policy_timings)
+        logger.info(f"Policies for subscription {subscription_id} applied in {time.perf_counter() - policies_start:.2f} seconds")
+        tc.flush()
+    except Exception as e:
+        logger.error(f"Error in subscription {subscription_id}: {e}")
+        tc.track_exception()
+        tc.flush()
+    finally:
+        await asyncio.to_thread(close_action_executors)
+        await close_async_subscription_clients(async_clients)
+
+async def async_process_subscriptions(subscriptions, mode, max_parallel_subscriptions=1, max_concurrent_requests=1000):
+    """Process subscriptions on the event loop and return their results in subscription order."""
+    request_semaphore = asyncio.Semaphore(max(1, max_concurrent_requests))
+    subscription_semaphore = asyncio.Semaphore(max(1, max_parallel_subscriptions))
+    # One connection pool shared by every async client of the run
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=max(1, max_concurrent_requests)),
+        cookie_jar=aiohttp.DummyCookieJar(),
+        auto_decompress=False,
+        trust_env=True,
+    )
+    transport = AioHttpTransport(session=session, session_owner=False)
+    async_credential = AsyncDefaultAzureCredential()
+
+    async def worker(subscription):
+        result = {
+            "summary_reports": [],
+            "impacted_resources": [],
+            "non_impacted_resources": [],
+            "status_log": [],
+            "policy_timings": [],
+            "daily_costs": [],
+        }
+        async with subscription_semaphore:
+            await async_process_subscription(subscription, mode, async_credential, transport, request_semaphore, result["summary_reports"], result["impacted_resources"], result["non_impacted_resources"], result["status_log"], result["policy_timings"], result["daily_costs"])
+        return result
+
+    logger.info(f"Processing {len(subscriptions)} subscription(s) with the async engine, up to {max_concurrent_requests} concurrent requests.")
+    try:
+        # Every subscription runs in its own task, so its context variables stay private to it
+        return await asyncio.gather(*(worker(subscription) for subscription in subscriptions))
+    finally:
+        await async_credential.close()
+        await session.close()
+
+def main(mode, all_subscriptions, use_adls=False, max_parallel_subscriptions=1, max_parallel_policies=1, engine="sync", max_concurrent_requests=1000, inventory_backend="arm", inventory_cache=None, full_refresh=False, max_parallel_metric_queries=8, metrics_cache=None, max_parallel_actions=1, max_parallel_actions_per_type=None, plan_out=None, plan=None, operations_store=None, max_parallel_sql_scales=1, max_parallel_sql_scales_per_server=None, state_store=None, snapshot=None, refresh_snapshot=False, policy_file=None, cost_store=None, cost_restatement_days=3, cost_scope=None, cost_cube=False):
     """Main function to run the Azure Cost Optimization Tool."""
     logger.info('Cost Optimizer Function triggered.')
     tc.track_event("FunctionTriggered")
@@ -1314,6 +3409,9 @@ def main(mode, all_subscriptions, use_adls=False):
     impacted_resources = []
     non_impacted_resources = []
     status_log = []
+    policy_timings = []
+    daily_costs = []
+    reconciled_operations = []
 
     cet = pytz.timezone("CET")
     now_cet = datetime.now(cet)
@@ -1321,21 +3419,85 @@ def main(mode, all_subscriptions, use_adls=False):
     end_date = now_cet.strftime('%Y-%m-%dT%H:%M:%SZ')
 
     try:
-        if all_subscriptions:
-            subscriptions = subscription_client.subscriptions.list()
-            for subscription in subscriptions:
-                subscription_id = subscription.subscription_id
-                process_subscription(subscription, mode, summary_reports, impacted_resources, non_impacted_resources, status_log, start_date, end_date, use_adls)
+        if plan:
+            # The plan was evaluated by a dry run, only its resources are revalidated and changed
+            run_context.set(create_run_context(max_parallel_actions=max_parallel_actions, max_parallel_actions_per_type=max_parallel_actions_per_type, operations_store=operations_store, state_store=state_store))
+            if operations_store:
+                reconciled_operations.extend(reconcile_operations())
+            results = apply_plan(load_plan(plan), max_parallel_subscriptions)
+        elif mode == "simulate":
+            policies = load_policies(policy_file or config['policies']['policy_file'], config['policies']['schema_file'])
+            if refresh_snapshot or not os.path.exists(snapshot):
+                # The only run of the simulation that reads from Azure
+                subscriptions = list(subscription_client.subscriptions.list()) if all_subscriptions else [subscription_client.subscriptions.get(os.getenv('AZURE_SUBSCRIPTION_ID'))]
+                run_context.set(create_run_context(inventory_backend, [subscription.subscription_id for subscription in subscriptions], inventory_cache, full_refresh, max_parallel_metric_queries, metrics_cache))
+                write_snapshot(snapshot, subscriptions, policies, max_parallel_subscriptions)
+            snapshot_data = load_snapshot(snapshot)
+            # The filters and cost reports are evaluated as of the capture, so the results do not depend on when the simulation runs
+            run_context.set(create_run_context(offline=True, reference_time=datetime.fromisoformat(snapshot_data["CapturedAt"])))
+            results = simulate(snapshot_data, policies, max_parallel_subscriptions, max_parallel_policies)
         else:
-            subscription_id = os.getenv('AZURE_SUBSCRIPTION_ID')
-            subscription = subscription_client.subscriptions.get(subscription_id)
-            process_subscription(subscription, mode, summary_reports, impacted_resources, non_impacted_resources, status_log, start_date, end_date, use_adls)
+            if all_subscriptions:
+                subscriptions = list(subscription_client.subscriptions.list())
+            else:
+                subscription_id = os.getenv('AZURE_SUBSCRIPTION_ID')
+                subscriptions = [subscription_client.subscriptions.get(subscription_id)]
+
+            # Cached CPU series are kept for the largest last_used window of the policies
+            policies = load_policies(config['policies']['policy_file'], config['policies']['schema_file'])
+            metrics_retention_days = max((filter["days"] for policy in policies for filter in policy["filters"] if filter["type"] == "last_used"), default=0)
+            run_context.set(create_run_context(inventory_backend, [subscription.subscription_id for subscription in subscriptions], inventory_cache, full_refresh, max_parallel_metric_queries, metrics_cache, metrics_retention_days, max_parallel_actions, max_parallel_actions_per_type, bool(plan_out), operations_store, max_parallel_sql_scales, max_parallel_sql_scales_per_server, state_store, cost_store=cost_store, cost_restatement_days=cost_restatement_days))
+            # Operations submitted by earlier runs are resolved first so they are not submitted twice
+            if operations_store:
+                reconciled_operations.extend(reconcile_operations())
+            if cost_scope:
+                get_run_context().grouped_cost_data.update(query_grouped_cost_data(cost_scope, [subscription.subscription_id for subscription in subscriptions]))
+
+            if engine == "async":
+                results = asyncio.run(async_process_subscriptions(subscriptions, mode, max_parallel_subscriptions, max_concurrent_requests))
+            else:
+                results = process_subscriptions(subscriptions, mode, start_date, end_date, use_adls, max_parallel_subscriptions, max_parallel_policies)
+            if plan_out:
+                write_plan(plan_out)
+        for result in results:
+            summary_reports.extend(result["summary_reports"])
+            impacted_resources.extend(result["impacted_resources"])
+            non_impacted_resources.extend(result["non_impacted_resources"])
+            status_log.extend(result["status_log"])
+            policy_timings.extend(result["policy_timings"])
+            daily_costs.extend(result["daily_costs"])
+
+        if cost_cube and (impacted_resources or daily_costs):
+            # One cube per run, every impacted resource is then attributed its cost by a hash lookup
+            subscription_ids = {resource["SubscriptionId"] for resource in impacted_resources} | {frame["scope"].iat[0] for frame in daily_costs}
+            cube = query_cost_cube([cost_scope] if cost_scope else [f"/subscriptions/{subscription_id}" for subscription_id in sorted(subscription_ids)])
+            for resource in impacted_resources:
+                resource["Cost"] = round(cube.get_resource_cost(resource.get("ResourceId")), 2)
+            daily_costs.append(get_resource_group_daily_costs(cube, get_reference_time(pytz.timezone("CET")).date()))
+
+        if daily_costs:
+            detection_start = time.perf_counter()
+            daily_cost_frame = pd.concat(daily_costs, ignore_index=True)
+            anomalies = detect_cost_anomalies(daily_cost_frame)
+            logger.info(f"Scored {daily_cost_frame['scope'].nunique()} daily cost series for anomalies in {time.perf_counter() - detection_start:.2f} seconds")
+            if anomalies.empty:
+                logger.info("No anomalies detected in the daily cost series.")
+                tc.track_event("NoCostAnomaliesDetected")
+            else:
+                table_anomalies = PrettyTable()
+                table_anomalies.field_names = ["Scope", "Date", "Cost", "Median", "Score"]
+                for anomaly in anomalies.itertuples():
+                    table_anomalies.add_row([wrap_text(anomaly.scope), anomaly.date.date().isoformat(), f"{anomaly.cost:.2f}", f"{anomaly.median:.2f}", f"{anomaly.score:.1f}"])
+                    tc.track_event("CostAnomalyDetected", {"Scope": anomaly.scope, "Date": anomaly.date.date().isoformat(), "Cost": anomaly.cost, "Score": anomaly.score})
+                print(colored("Cost Anomalies:", "red", attrs=["bold"]))
+                print(colored(table_anomalies.get_string(), "red"))
+            tc.track_metric("CostAnomalies", len(anomalies))
 
         if impacted_resources:
             table_impacted_resources = PrettyTable()
-            table_impacted_resources.field_names = ["Subscription ID", "Policy", "Resource", "Actions", "Owner"]
+            table_impacted_resources.field_names = ["Subscription ID", "Policy", "Resource", "Actions", "Owner"] + (["Cost (30 days)"] if cost_cube else [])
             for resource in impacted_resources:
-                table_impacted_resources.add_row([resource["SubscriptionId"], resource["Policy"], wrap_text(resource["Resource"]), resource["Actions"], resource["Owner"]])
+                table_impacted_resources.add_row([resource["SubscriptionId"], resource["Policy"], wrap_text(resource["Resource"]), resource["Actions"], resource["Owner"]] + ([f'{resource["Cost"]:.2f}'] if cost_cube else []))
             print(colored("Impacted Resources:", "cyan", attrs=["bold"]))
             print(colored(table_impacted_resources.get_string(), "cyan"))
 
@@ -1361,6 +3523,30 @@ def main(mode, all_subscriptions, use_adls=False):
             print(colored("Action Status Log:", "cyan", attrs=["bold"]))
             print(colored(table_status_log.get_string(), "cyan"))
 
+        if policy_timings:
+            table_policy_timings = PrettyTable()
+            table_policy_timings.field_names = ["Subscription ID", "Policy", "ResourceType", "Duration (s)"]
+            for timing in policy_timings:
+                table_policy_timings.add_row([timing["SubscriptionId"], wrap_text(timing["Policy"]), timing["ResourceType"], f'{timing["Duration"]:.2f}'])
+            print(colored("Policy Timings:", "cyan", attrs=["bold"]))
+            print(colored(table_policy_timings.get_string(), "cyan"))
+
+        sql_fleet = get_run_context().sql_fleet
+        if sql_fleet.databases:
+            time_to_converge = sql_fleet.converged - sql_fleet.started
+            print(colored(f"SQL fleet: {sql_fleet.databases} databases rescaled in {time_to_converge:.2f} seconds", "cyan", attrs=["bold"]))
+            tc.track_metric("SqlFleetTimeToConverge", time_to_converge, properties={"Databases": sql_fleet.databases})
+
+        if operations_store:
+            reconciled_operations.extend(reconcile_operations())
+        if reconciled_operations:
+            table_reconciled_operations = PrettyTable()
+            table_reconciled_operations.field_names = ["Subscription ID", "Resource", "Operation", "Status", "Message"]
+            for operation in reconciled_operations:
+                table_reconciled_operations.add_row([operation["SubscriptionId"], wrap_text(operation["Resource"]), operation["Operation"], operation["Status"], wrap_text(operation["Message"])])
+            print(colored("Reconciled Operations:", "cyan", attrs=["bold"]))
+            print(colored(table_reconciled_operations.get_string(), "cyan"))
+
     except KeyError as e:
         logger.error(f"KeyError: {e}")
     except Exception as e:
@@ -1392,9 +3578,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Azure Cost Optimization Tool")
     parser.add_argument(
         "--mode",
-        choices=["dry-run", "apply"],
+        choices=["dry-run", "apply", "simulate"],
         required=True,
-        help="Mode to run the function (dry-run or apply)",
+        help="Mode to run the function (dry-run, apply, or simulate against a snapshot)",
     )
     parser.add_argument(
         "--all-subscriptions",
@@ -1406,7 +3592,141 @@ if __name__ == "__main__":
         action="store_true",
         help="Use Azure Data Lake Storage for waste cost data",
     )
+    parser.add_argument(
+        "--max-parallel-subscriptions",
+        type=int,
+        default=1,
+        help="Maximum number of subscriptions processed in parallel",
+    )
+    parser.add_argument(
+        "--max-parallel-policies",
+        type=int,
+        default=1,
+        help="Maximum number of policies evaluated concurrently within a subscription",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["sync", "async"],
+        default="sync",
+        help="Execution engine: blocking SDK clients (sync) or asyncio SDK clients on one event loop (async)",
+    )
+    parser.add_argument(
+        "--max-concurrent-requests",
+        type=int,
+        default=1000,
+        help="Maximum number of in-flight ARM requests when using the async engine",
+    )
+    parser.add_argument(
+        "--inventory-backend",
+        choices=["arm", "resourcegraph"],
+        default="arm",
+        help="List resources per subscription through the management clients (arm) or for all subscriptions at once through Azure Resource Graph (resourcegraph)",
+    )
+    parser.add_argument(
+        "--inventory-cache",
+        help="SQLite file keeping the Resource Graph inventory between runs, only resources changed since the last snapshot are refreshed",
+    )
+    parser.add_argument(
+        "--full-refresh",
+        action="store_true",
+        help="Ignore the inventory cache snapshot and re-download the whole inventory",
+    )
+    parser.add_argument(
+        "--max-parallel-metric-queries",
+        type=int,
+        default=8,
+        help="Maximum number of batch metrics queries (up to 50 VMs each) in flight per subscription",
+    )
+    parser.add_argument(
+        "--metrics-cache",
+        help="SQLite file keeping the hourly CPU series of VMs between runs, only the hours missing since the last run are queried",
+    )
+    parser.add_argument(
+        "--max-parallel-actions",
+        type=int,
+        default=1,
+        help="Maximum number of write operations (deallocate, delete, SKU updates) in flight per subscription",
+    )
+    parser.add_argument(
+        "--max-parallel-actions-per-type",
+        type=int,
+        help="Maximum number of write operations in flight per subscription and resource type (default: --max-parallel-actions)",
+    )
+    parser.add_argument(
+        "--plan-out",
+        help="Write the resources and actions selected by a dry run, with the evidence behind them, to a JSON plan file",
+    )
+    parser.add_argument(
+        "--plan",
+        help="Apply a plan file written by --plan-out instead of evaluating the policies again",
+    )
+    parser.add_argument(
+        "--operations-store",
+        help="SQLite file recording resource group deletions and SQL rescales as pending operations that later runs reconcile, instead of waiting for them",
+    )
+    parser.add_argument(
+        "--max-parallel-sql-scales",
+        type=int,
+        default=1,
+        help="Maximum number of SQL database rescales in flight per subscription (default: 1)",
+    )
+    parser.add_argument(
+        "--max-parallel-sql-scales-per-server",
+        type=int,
+        default=None,
+        help="Maximum number of SQL database rescales in flight per logical server (default: --max-parallel-sql-scales)",
+    )
+    parser.add_argument(
+        "--state-store",
+        help="SQLite file recording resources whose actions succeeded, so they are skipped until their ETag changes",
+    )
+    parser.add_argument(
+        "--cost-store",
+        help="SQLite file keeping the daily cost of every subscription, so only missing days and the restatement window are queried",
+    )
+    parser.add_argument(
+        "--cost-restatement-days",
+        type=int,
+        default=3,
+        help="With --cost-store, number of most recent days queried again on every run for late-arriving charges (default: 3)",
+    )
+    parser.add_argument(
+        "--cost-scope",
+        help="Billing account or management group scope (e.g. /providers/Microsoft.Management/managementGroups/<id>) whose cost is queried once, grouped by subscription, instead of once per subscription",
+    )
+    parser.add_argument(
+        "--cost-cube",
+        action="store_true",
+        help="Attribute the cost of the last 30 days to every impacted resource from a cost cube queried once per run by resource and meter category",
+    )
+    parser.add_argument(
+        "--snapshot",
+        help="With --mode simulate, JSON snapshot of inventory, metrics and cost data to evaluate the policies against, captured first if it does not exist",
+    )
+    parser.add_argument(
+        "--refresh-snapshot",
+        action="store_true",
+        help="With --mode simulate, capture the snapshot again even if it exists",
+    )
+    parser.add_argument(
+        "--policy-file",
+        help="With --mode simulate, policy file to evaluate instead of the one of the configuration",
+    )
     args = parser.parse_args()
-    main(args.mode, args.all_subscriptions, args.use_adls)
+    if args.inventory_cache and args.inventory_backend != "resourcegraph":
+        parser.error("--inventory-cache requires --inventory-backend resourcegraph")
+    if args.plan_out and args.mode != "dry-run":
+        parser.error("--plan-out requires --mode dry-run")
+    if args.plan and args.mode != "apply":
+        parser.error("--plan requires --mode apply")
+    if (args.mode == "simulate") != bool(args.snapshot):
+        parser.error("--mode simulate requires --snapshot, and --snapshot requires --mode simulate")
+    if (args.refresh_snapshot or args.policy_file) and args.mode != "simulate":
+        parser.error("--refresh-snapshot and --policy-file require --mode simulate")
+    if args.cost_restatement_days < 1:
+        parser.error("--cost-restatement-days must be at least 1, today's cost is never final")
+    if args.cost_cube and args.mode == "simulate":
+        parser.error("--cost-cube cannot be used with --mode simulate")
+    main(args.mode, args.all_subscriptions, args.use_adls, args.max_parallel_subscriptions, args.max_parallel_policies, args.engine, args.max_concurrent_requests, args.inventory_backend, args.inventory_cache, args.full_refresh, args.max_parallel_metric_queries, args.metrics_cache, args.max_parallel_actions, args.max_parallel_actions_per_type, args.plan_out, args.plan, args.operations_store, args.max_parallel_sql_scales, args.max_parallel_sql_scales_per_server, args.state_store, args.snapshot, args.refresh_snapshot, args.policy_file, args.cost_store, args.cost_restatement_days, args.cost_scope, args.cost_cube)
     print(colored("Azure Cost Optimizer Tool completed!", "green"))
     print(colored("=" * 110, "black"))
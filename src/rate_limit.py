@@ -0,0 +1,184 @@
+# src/rate_limit.py is copied to CostOptimizerFunction/HttpTrigger1/rate_limit.py for the function app, CI checks the copies match
+
+import asyncio
+import json
+import logging
+import math
+import threading
+import time
+from datetime import datetime
+
+from azure.core.pipeline.policies import HTTPPolicy, AsyncHTTPPolicy
+
+logger = logging.getLogger(__name__)
+
+# ARM token bucket sizes and refill rates (tokens per second) per subscription and request kind.
+# The x-ms-ratelimit-remaining-* response headers lower the buckets to what ARM reports.
+RATE_LIMIT_BUCKETS = {
+    "reads": (250, 25),
+    "writes": (200, 10),
+    "deletes": (200, 10),
+}
+# Tenant-wide Cost Management query processing unit (QPU) budgets: (capacity, refill rate per second)
+# for the 12 per 10 seconds, 60 per minute and 600 per hour limits
+COST_QUERY_QPU_BUCKETS = [(12, 1.2), (60, 1), (600, 1 / 6)]
+
+def get_retry_after(headers):
+    """Return the longest delay in seconds asked for by the Retry-After style headers of a response."""
+    retry_after = 0
+    for name, value in headers.items():
+        name = name.lower()
+        try:
+            if name.endswith("retry-after-ms"):
+                retry_after = max(retry_after, int(value) / 1000)
+            elif name.endswith("retry-after"):
+                retry_after = max(retry_after, float(value))
+        except ValueError:
+            logger.debug(f"Ignoring unparsable retry header {name}: {value}")
+    return retry_after
+
+class TokenBucket:
+    """Token bucket pacing the requests sent for one subscription or provider."""
+
+    def __init__(self, capacity, refill_rate):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Take tokens and return how many seconds the caller has to wait before sending."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_rate) - tokens
+            self.updated = now
+            return max(0, -self.tokens / self.refill_rate, self.blocked_until - now)
+
+    def observe(self, remaining):
+        """Lower the bucket to the number of requests ARM reports as remaining."""
+        with self.lock:
+            self.tokens = min(self.tokens, remaining)
+
+    def block(self, seconds):
+        """Hold every request of the bucket for the Retry-After delay of a throttled response."""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+def is_cost_query(request):
+    """Whether a request is a Cost Management query, including its continuation pages."""
+    return "/providers/microsoft.costmanagement/query" in request.url.lower()
+
+def estimate_cost_query_qpu(request):
+    """Estimate the QPUs a Cost Management query consumes: one per month of data queried."""
+    try:
+        body = request.body if getattr(request, "body", None) is not None else request.content
+        time_period = json.loads(body)["timePeriod"]
+        days = (datetime.fromisoformat(time_period["to"]) - datetime.fromisoformat(time_period["from"])).days + 1
+        return max(1, math.ceil(days / 31))
+    except (TypeError, ValueError, KeyError, AttributeError):
+        return 1
+
+def parse_rate_limit_values(value):
+    """Return the numbers of a rate limit header value such as "12" or "QueryResource:12, QueryTenant:60"."""
+    return [float(entry.replace("=", ":").split(":")[-1]) for entry in value.replace(";", ",").split(",") if entry.strip()]
+
+class RateLimitGovernor:
+    """Per-subscription and per-provider token buckets shared by every client of a run."""
+
+    def __init__(self, telemetry_client=None):
+        self.telemetry_client = telemetry_client
+        self.buckets = {}
+        self.lock = threading.Lock()
+        # Cost Management queries are limited per tenant in QPUs rather than in requests
+        self.qpu_buckets = [TokenBucket(capacity, refill_rate) for capacity, refill_rate in COST_QUERY_QPU_BUCKETS]
+
+    def get_buckets(self, request):
+        """Return the subscription and provider buckets a request draws from."""
+        method = request.method.upper()
+        kind = "reads" if method in ("GET", "HEAD") else "deletes" if method == "DELETE" else "writes"
+        segments = [segment.lower() for segment in request.url.split("?")[0].split("/")]
+        subscription_id, provider = "tenant", None
+        for index, segment in enumerate(segments[:-1]):
+            if segment == "subscriptions" and subscription_id == "tenant":
+                subscription_id = segments[index + 1]
+            elif segment == "providers":
+                # The innermost provider, e.g. Microsoft.Insights for metrics of a VM
+                provider = segments[index + 1]
+        keys = [(subscription_id, None, kind)] + ([(subscription_id, provider, kind)] if provider else [])
+        with self.lock:
+            return [self.buckets.setdefault(key, TokenBucket(*RATE_LIMIT_BUCKETS[kind])) for key in keys]
+
+    def reserve(self, request):
+        """Take a token from every bucket of a request and return how long to wait before sending it."""
+        delay = max(bucket.reserve() for bucket in self.get_buckets(request))
+        if is_cost_query(request):
+            # Reservations are served in order, so queued queries are spread over the QPU budget instead of all hitting 429
+            qpu = estimate_cost_query_qpu(request)
+            delay = max([delay] + [bucket.reserve(qpu) for bucket in self.qpu_buckets])
+        return delay
+
+    def observe(self, request, response):
+        """Feed the rate limit headers of a response back into the buckets of its request."""
+        subscription_bucket, *provider_buckets = self.get_buckets(request)
+        retry_after = get_retry_after(response.headers)
+        for name, value in response.headers.items():
+            name = name.lower()
+            try:
+                if name.startswith("x-ms-ratelimit-remaining-subscription-") or name.startswith("x-ms-ratelimit-remaining-tenant-"):
+                    subscription_bucket.observe(int(value))
+                elif name == "x-ms-ratelimit-remaining-resource":
+                    # e.g. "Microsoft.Compute/HighCostGet3Min;159,Microsoft.Compute/HighCostGet30Min;799"
+                    remaining = min(int(entry.split(";")[1]) for entry in value.split(","))
+                    for bucket in provider_buckets:
+                        bucket.observe(remaining)
+                elif name == "x-ms-ratelimit-microsoft.costmanagement-qpu-remaining":
+                    # One value per limit window; the smallest values belong to the shortest windows
+                    for bucket, remaining in zip(self.qpu_buckets, sorted(parse_rate_limit_values(value))):
+                        bucket.observe(remaining)
+                elif name == "x-ms-ratelimit-microsoft.costmanagement-qpu-consumed":
+                    consumed = sum(parse_rate_limit_values(value))
+                    if self.telemetry_client:
+                        self.telemetry_client.track_metric("CostQueryQpu", consumed)
+                    # Charge what the query cost beyond its estimate
+                    extra = consumed - estimate_cost_query_qpu(request)
+                    if extra > 0:
+                        for bucket in self.qpu_buckets:
+                            bucket.reserve(extra)
+            except (ValueError, IndexError):
+                logger.debug(f"Ignoring unparsable rate limit header {name}: {value}")
+        if response.status_code in (429, 503) and retry_after:
+            logger.warning(f"Throttled on {request.method} {request.url.split('?')[0]}, holding requests for {retry_after:.0f} seconds")
+            for bucket in [subscription_bucket, *provider_buckets] + (self.qpu_buckets if is_cost_query(request) else []):
+                bucket.block(retry_after)
+
+class RateLimitPolicy(HTTPPolicy):
+    """Pipeline policy pacing every attempt of a request through the rate limit governor."""
+
+    def __init__(self, governor):
+        super().__init__()
+        self.governor = governor
+
+    def send(self, request):
+        delay = self.governor.reserve(request.http_request)
+        if delay:
+            time.sleep(delay)
+        response = self.next.send(request)
+        self.governor.observe(request.http_request, response.http_response)
+        return response
+
+class AsyncRateLimitPolicy(AsyncHTTPPolicy):
+    """Async pipeline policy pacing every attempt of a request through the rate limit governor."""
+
+    def __init__(self, governor):
+        super().__init__()
+        self.governor = governor
+
+    async def send(self, request):
+        delay = self.governor.reserve(request.http_request)
+        if delay:
+            await asyncio.sleep(delay)
+        response = await self.next.send(request)
+        self.governor.observe(request.http_request, response.http_response)
+        return response